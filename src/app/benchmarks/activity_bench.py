@@ -0,0 +1,91 @@
+# Rows/sec of the conversion and ingestion activities on their own, run
+# outside a worker through temporalio's ActivityEnvironment. Needs the
+# database (DATABASE_URL) and S3 (LocalStack under docker-compose).
+#
+#   python -m benchmarks.activity_bench --ingestions 20 --items 5000
+#   INTERMEDIATE_FORMAT=parquet python -m benchmarks.activity_bench
+#
+# Seeded ingestions and the ingested rows are committed (MRNs prefixed
+# BENCH-); the uploaded objects are deleted afterwards.
+import argparse
+import hashlib
+import json
+import time
+import uuid
+
+from sqlalchemy import text
+from temporalio.testing import ActivityEnvironment
+
+from services.database import SessionLocal
+from services.formats import INTERMEDIATE_FORMAT
+from services.migrations import migrate
+from services.s3 import delete_object
+from services.uploads import canonical_payload
+from temporal.activities import convert_and_upload_csv, ingest_csv_from_s3
+from benchmarks.datagen import synthetic_rows
+
+
+def seed(ingestions: int, items: int, duplicates: float) -> list:
+    prefix = f"BENCH-{uuid.uuid4().hex[:8]}"
+    rows = synthetic_rows(ingestions * items, prefix=prefix, duplicates=duplicates)
+    db = SessionLocal()
+    try:
+        ids = []
+        for _ in range(ingestions):
+            payload = canonical_payload(json.dumps([next(rows) for _ in range(items)]).encode())
+            ids.append(
+                db.execute(
+                    text(
+                        """
+                        INSERT INTO ingestions (payload, md5_hash)
+                        VALUES (:payload, :md5_hash)
+                        RETURNING id
+                        """
+                    ),
+                    {
+                        "payload": payload,
+                        "md5_hash": hashlib.md5(payload.encode("utf-8")).hexdigest(),
+                    },
+                ).scalar()
+            )
+        db.commit()
+        return ids
+    finally:
+        db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ingestions", type=int, default=20)
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--duplicates", type=float, default=0.0)
+    args = parser.parse_args()
+
+    migrate()
+    ids = seed(args.ingestions, args.items, args.duplicates)
+    rows = args.ingestions * args.items
+    env = ActivityEnvironment()
+
+    started = time.perf_counter()
+    s3_paths = [env.run(convert_and_upload_csv, entry_id)["s3_path"] for entry_id in ids]
+    converted = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for s3_path in s3_paths:
+        env.run(ingest_csv_from_s3, s3_path)
+    ingested = time.perf_counter() - started
+
+    for s3_path in s3_paths:
+        delete_object(s3_path)
+
+    print(f"{args.ingestions} ingestions x {args.items} items, format {INTERMEDIATE_FORMAT}")
+    print(f"{'activity':<24} {'s':>9} {'rows/s':>10}")
+    for label, elapsed in (
+        ("convert_and_upload_csv", converted),
+        ("ingest_csv_from_s3", ingested),
+    ):
+        print(f"{label:<24} {elapsed:>9.3f} {rows / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
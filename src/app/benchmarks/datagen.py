@@ -0,0 +1,47 @@
+import random
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Optional
+
+FIRST_NAMES = ["John", "Jane", "Maria", "Ahmed", "Wei", "Olga", "Carlos", "Aisha", "Liam", "Noor"]
+LAST_NAMES = ["Doe", "Smith", "Garcia", "Khan", "Chen", "Ivanova", "Santos", "Okafor", "Murphy", "Haddad"]
+REASONS = ["Annual Checkup", "Follow-up", "Flu Symptoms", "Lab Work", "Vaccination", "Consultation"]
+
+# Earlier rows a duplicate may be copied from
+DUPLICATE_POOL = 10000
+
+
+# `duplicates` is the share of rows that repeat an earlier row verbatim (same
+# visit account number and content), as resubmitted exports do
+def synthetic_rows(
+    count: int,
+    patients: Optional[int] = None,
+    prefix: str = "BENCH",
+    seed: int = 0,
+    duplicates: float = 0.0,
+) -> Iterator[Dict[str, str]]:
+    rng = random.Random(seed)
+    patients = patients or max(1, count // 4)
+    start = date(2015, 1, 1)
+    earlier: List[Dict[str, str]] = []
+
+    for i in range(count):
+        if duplicates and earlier and rng.random() < duplicates:
+            yield dict(rng.choice(earlier))
+            continue
+
+        patient = rng.randrange(patients)
+        row = {
+            "mrn": f"{prefix}-MRN-{patient}",
+            "first_name": FIRST_NAMES[patient % len(FIRST_NAMES)],
+            "last_name": LAST_NAMES[(patient // len(FIRST_NAMES)) % len(LAST_NAMES)],
+            "birth_date": (date(1940, 1, 1) + timedelta(days=patient % 25000)).isoformat(),
+            "visit_account_number": f"{prefix}-VST-{i}",
+            "visit_date": (start + timedelta(days=rng.randrange(3650))).isoformat(),
+            "reason": rng.choice(REASONS),
+        }
+        if duplicates:
+            if len(earlier) < DUPLICATE_POOL:
+                earlier.append(row)
+            else:
+                earlier[rng.randrange(DUPLICATE_POOL)] = row
+        yield row
@@ -0,0 +1,57 @@
+# Compare rows/sec of the per-row and the set-based ingestion paths.
+#
+#   python -m benchmarks.ingest_bench --rows 20000 --patients 5000
+#
+# Each run happens inside a transaction that is rolled back, so the target
+# database (DATABASE_URL) is left untouched apart from advanced sequences.
+import argparse
+import time
+import uuid
+
+from services.database import SessionLocal
+from services.ingestion import bulk_ingest_rows, ingest_rows
+from services.migrations import migrate
+from benchmarks.datagen import synthetic_rows
+
+MODES = {
+    "row": ingest_rows,
+    "bulk": bulk_ingest_rows,
+}
+
+
+def run(mode: str, rows: list) -> float:
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        MODES[mode](db, iter(rows))
+        db.flush()
+        elapsed = time.perf_counter() - started
+        db.rollback()
+        return elapsed
+    finally:
+        db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--patients", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    migrate()
+
+    print(f"{'mode':<6} {'rows':>8} {'best s':>9} {'rows/s':>10}")
+    for mode in args.modes:
+        timings = []
+        for _ in range(args.repeat):
+            prefix = f"BENCH-{uuid.uuid4().hex[:8]}"
+            rows = list(synthetic_rows(args.rows, args.patients, prefix=prefix))
+            timings.append(run(mode, rows))
+        best = min(timings)
+        print(f"{mode:<6} {args.rows:>8} {best:>9.3f} {args.rows / best:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# End-to-end load test: POST /ingest -> CsvConversionWorkflow ->
+# CsvIngestionWorkflow, against a running stack (`make start`).
+#
+#   python -m benchmarks.loadtest --requests 200 --items 100 --concurrency 16
+#
+# A request counts as done once every visit of its payload is in the
+# database (polled through DATABASE_URL), so the reported latency covers the
+# API, Temporal, S3 and the ingestion. Payloads are committed with MRNs and
+# visit account numbers prefixed LOAD-.
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from itertools import islice
+
+import httpx
+from sqlalchemy import text
+
+from services.database import AsyncSessionLocal
+from benchmarks.datagen import synthetic_rows
+
+
+def percentile(samples: list, q: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def build_payloads(args, prefix: str) -> list:
+    rng = random.Random(args.seed)
+    rows = synthetic_rows(
+        args.requests * args.items,
+        args.patients,
+        prefix=prefix,
+        seed=args.seed,
+        duplicates=args.duplicates,
+    )
+    payloads = []
+    for _ in range(args.requests):
+        if payloads and rng.random() < args.resend:
+            # Same body as an earlier request; the API answers "existing"
+            payloads.append(rng.choice(payloads))
+        else:
+            payloads.append(list(islice(rows, args.items)))
+    return payloads
+
+
+async def send(client: httpx.AsyncClient, payload: list, limit: asyncio.Semaphore) -> dict:
+    async with limit:
+        started = time.perf_counter()
+        response = await client.post("/ingest", json=payload)
+        return {
+            "started": started,
+            "latency": time.perf_counter() - started,
+            "status": response.status_code,
+            "body": response.json() if response.status_code == 200 else None,
+        }
+
+
+async def landed(requests: dict) -> set:
+    # Requests (by index) whose visits are all in the database
+    indexes, accounts = [], []
+    for index, payload in requests.items():
+        for row in payload:
+            indexes.append(index)
+            accounts.append(row["visit_account_number"])
+
+    async with AsyncSessionLocal() as db:
+        counts = (
+            await db.execute(
+                text(
+                    """
+                    SELECT r.idx, count(DISTINCT v.visit_account_number) AS found
+                    FROM unnest(CAST(:indexes AS int[]), CAST(:accounts AS text[]))
+                        AS r(idx, visit_account_number)
+                    LEFT JOIN visits v USING (visit_account_number)
+                    GROUP BY r.idx
+                    """
+                ),
+                {"indexes": indexes, "accounts": accounts},
+            )
+        ).all()
+
+    expected = {
+        index: len({row["visit_account_number"] for row in payload})
+        for index, payload in requests.items()
+    }
+    return {index for index, found in counts if found == expected[index]}
+
+
+async def run(args) -> None:
+    prefix = f"LOAD-{uuid.uuid4().hex[:8]}"
+    payloads = build_payloads(args, prefix)
+    unique_rows = len({row["visit_account_number"] for payload in payloads for row in payload})
+
+    limit = asyncio.Semaphore(args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.http_timeout) as client:
+        started = time.perf_counter()
+        sent = await asyncio.gather(*(send(client, payload, limit) for payload in payloads))
+        accepted = time.perf_counter()
+
+    pending = {i: payloads[i] for i, result in enumerate(sent) if result["status"] == 200}
+    finished = {}
+    deadline = accepted + args.timeout
+    while pending and time.perf_counter() < deadline:
+        await asyncio.sleep(args.poll_interval)
+        now = time.perf_counter()
+        for index in await landed(pending):
+            finished[index] = now - sent[index]["started"]
+            del pending[index]
+    done = time.perf_counter() if not pending else None
+
+    statuses = {}
+    for result in sent:
+        key = result["body"]["status"] if result["body"] else f"http {result['status']}"
+        statuses[key] = statuses.get(key, 0) + 1
+
+    print(
+        f"{args.requests} requests x {args.items} items, concurrency {args.concurrency}, "
+        f"{unique_rows} unique rows ({args.duplicates:.0%} duplicate rows, "
+        f"{args.resend:.0%} resent payloads)"
+    )
+    print("responses: " + ", ".join(f"{k}={v}" for k, v in sorted(statuses.items())))
+    print(f"{'stage':<12} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for label, samples in (
+        ("http", [result["latency"] for result in sent]),
+        ("end-to-end", list(finished.values())),
+    ):
+        if samples:
+            print(
+                f"{label:<12} "
+                + " ".join(f"{percentile(samples, q) * 1000:>9.0f}" for q in (0.5, 0.95, 0.99))
+                + f" {max(samples) * 1000:>9.0f}"
+            )
+    print(f"accepted: {args.requests / (accepted - started):.1f} requests/s")
+    if done is not None:
+        print(f"ingested: {unique_rows / (done - started):.0f} rows/s end-to-end")
+    else:
+        print(f"timed out after {args.timeout}s with {len(pending)} requests not ingested")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--patients", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duplicates", type=float, default=0.0)
+    parser.add_argument("--resend", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--http-timeout", type=float, default=60)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# Latency of GET /patients with the per-patient visits queries it used to run
+# (one query per patient on the page) versus the single ROW_NUMBER() window query.
+#
+#   python -m benchmarks.patients_bench --seed 200000 --page-size 100
+#
+# --seed ingests synthetic rows first (committed, MRNs prefixed BENCH-);
+# without it the benchmark runs against whatever is already in the database.
+import argparse
+import statistics
+import time
+import uuid
+
+from sqlalchemy import text
+
+from routes.patients import RECENT_VISITS_LIMIT, _recent_visits, listPatients
+from services.database import SessionLocal
+from services.ingestion import bulk_ingest_rows
+from services.migrations import migrate
+from benchmarks.datagen import synthetic_rows
+
+
+def per_patient_visits(db, patient_ids):
+    return {
+        patient_id: [
+            dict(v)
+            for v in db.execute(
+                text(
+                    """
+                    SELECT id, visit_account_number, visit_date, reason
+                    FROM visits
+                    WHERE patient_id = :patient_id
+                    ORDER BY visit_date DESC
+                    LIMIT :limit
+                    """
+                ),
+                {"patient_id": patient_id, "limit": RECENT_VISITS_LIMIT},
+            ).mappings()
+        ]
+        for patient_id in patient_ids
+    }
+
+
+def list_page(db, page: int, page_size: int) -> dict:
+    return listPatients(
+        mrn=None,
+        first_name=None,
+        last_name=None,
+        page=page,
+        page_size=page_size,
+        cursor=None,
+        count="exact",
+        db=db,
+    )
+
+
+def seed(rows: int) -> None:
+    db = SessionLocal()
+    try:
+        prefix = f"BENCH-{uuid.uuid4().hex[:8]}"
+        bulk_ingest_rows(db, synthetic_rows(rows, prefix=prefix))
+        db.commit()
+    finally:
+        db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    migrate()
+    if args.seed:
+        seed(args.seed)
+
+    import routes.patients as patients_route
+
+    timings = {"before": [], "after": []}
+    db = SessionLocal()
+    try:
+        for _ in range(args.repeat):
+            for page in range(1, args.pages + 1):
+                for label, loader in (("before", per_patient_visits), ("after", _recent_visits)):
+                    patients_route._recent_visits = loader
+                    started = time.perf_counter()
+                    list_page(db, page, args.page_size)
+                    timings[label].append((time.perf_counter() - started) * 1000)
+    finally:
+        patients_route._recent_visits = _recent_visits
+        db.close()
+
+    print(f"page_size={args.page_size}, {len(timings['after'])} requests each")
+    print(f"{'path':<8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for label, samples in timings.items():
+        samples.sort()
+        p95 = samples[int(len(samples) * 0.95) - 1]
+        print(f"{label:<8} {statistics.median(samples):>8.2f} {p95:>8.2f} {samples[-1]:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
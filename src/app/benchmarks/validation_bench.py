@@ -0,0 +1,61 @@
+# Items/sec of validating and hashing a POST /ingest body the way the route
+# used to (json.loads, IngestItem models, normalized dicts, json.dumps with
+# sort_keys) versus canonical_payload (validate_json on the raw bytes and a
+# hand-built canonical encoding). Both must produce the same md5_hash.
+#
+#   python -m benchmarks.validation_bench --items 5000
+import argparse
+import hashlib
+import json
+import statistics
+import time
+from typing import List
+
+from pydantic import TypeAdapter
+
+from models import IngestItem
+from services.uploads import canonical_payload, normalize_item
+from benchmarks.datagen import synthetic_rows
+
+LEGACY_ITEMS = TypeAdapter(List[IngestItem])
+
+
+def legacy_hash(body: bytes) -> str:
+    items = LEGACY_ITEMS.validate_python(json.loads(body))
+    payload_str = json.dumps(
+        [normalize_item(item) for item in items], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.md5(payload_str.encode("utf-8")).hexdigest()
+
+
+def fast_hash(body: bytes) -> str:
+    return hashlib.md5(canonical_payload(body).encode("utf-8")).hexdigest()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = list(synthetic_rows(args.items))
+    # Non-ASCII and characters JSON has to escape
+    for row in rows[::7]:
+        row["first_name"] = "Zoë \"Jo\"\t"
+        row["reason"] = "Revisión\\\n☃"
+    body = json.dumps(rows).encode("utf-8")
+
+    assert legacy_hash(body) == fast_hash(body)
+
+    for name, fn in (("before", legacy_hash), ("after", fast_hash)):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            fn(body)
+            timings.append(time.perf_counter() - start)
+        median = statistics.median(timings)
+        print(f"{name:>6}: {args.items / median:>10.0f} items/s  (median {median * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
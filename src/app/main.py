@@ -1,12 +1,68 @@
-from fastapi import FastAPI
+import time
+from asyncio import to_thread
+
+from fastapi import FastAPI, Request
 from routes import routes
-from services.database import initialize
+from services.cache import PATIENT_CHANGES_CHANNEL, patient_cache, patient_tag
+from services.database import async_engine
+from services.ingestion_events import INGESTION_STATUS_CHANNEL, status_broker
+from services.metrics import HTTP_REQUEST_SECONDS
+from services.migrations import MIGRATE_ON_STARTUP, migrate
+from services.notifications import listener
+from services.outbox import OUTBOX_CHANNEL, dispatcher
+from services.partitions import ensure_future_visit_partitions, partition_scheduler
 
 app = FastAPI(title="ODI Exam API", version="0.1.0")
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Route template (/patients/{patient_id}) rather than the raw path,
+        # so the label set stays bounded
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.labels(
+            request.method,
+            route.path if route is not None else "unmatched",
+            str(status),
+        ).observe(time.perf_counter() - started)
+
 @app.on_event("startup")
 async def startup_event() -> None:
-    await initialize()
+    if MIGRATE_ON_STARTUP:
+        await to_thread(migrate)
+    await to_thread(ensure_future_visit_partitions)
+
+    listener.start()
+    dispatcher.start()
+    partition_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    await partition_scheduler.stop()
+    await dispatcher.stop()
+    await listener.stop()
+    await async_engine.dispose()
+
+def invalidate_patients(payload: str) -> None:
+    patient_cache.invalidate(patient_tag(int(i)) for i in payload.split(","))
+
+listener.subscribe(PATIENT_CHANGES_CHANNEL, invalidate_patients)
+# Invalidations sent while the listener was disconnected are lost
+listener.on_reconnect(patient_cache.clear)
+
+# Wake the outbox dispatcher as soon as an ingestion commits
+listener.subscribe(OUTBOX_CHANNEL, dispatcher.wake)
+listener.on_reconnect(dispatcher.wake)
+
+# Pushes status changes to the open /ingestions/events streams
+listener.subscribe(INGESTION_STATUS_CHANNEL, status_broker.publish)
+listener.on_reconnect(status_broker.resync)
 
 for route in routes:
-    app.include_router(route)
\ No newline at end of file
+    app.include_router(route)
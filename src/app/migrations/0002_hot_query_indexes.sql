@@ -0,0 +1,18 @@
+-- migrate: no-transaction
+-- Indexes are built CONCURRENTLY so existing tables stay writable while they
+-- build; that cannot happen inside a transaction block. An INVALID index
+-- left by a failed build is dropped by the migration runner before its
+-- statement is retried.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Patient detail / recent visits: WHERE patient_id = ? ORDER BY visit_date DESC, id DESC
+CREATE INDEX CONCURRENTLY IF NOT EXISTS visits_patient_id_visit_date_idx
+    ON visits (patient_id, visit_date DESC, id DESC);
+
+-- Name search: ILIKE '%...%' on first/last name
+CREATE INDEX CONCURRENTLY IF NOT EXISTS persons_first_name_trgm_idx
+    ON persons USING gin (first_name gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS persons_last_name_trgm_idx
+    ON persons USING gin (last_name gin_trgm_ops);
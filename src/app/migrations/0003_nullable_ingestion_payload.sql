@@ -0,0 +1,3 @@
+-- Ingestions streamed through /ingest/stream go straight to S3 and have no
+-- JSON payload
+ALTER TABLE ingestions ALTER COLUMN payload DROP NOT NULL;
@@ -0,0 +1,30 @@
+-- Content hash of the last ingested row for each visit_account_number, used
+-- to skip rows that are resent unchanged. Missing values hash like empty
+-- strings, which is how they come back out of the converted CSV.
+CREATE OR REPLACE FUNCTION ingest_row_hash(
+    mrn TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    birth_date TEXT,
+    visit_account_number TEXT,
+    visit_date TEXT,
+    reason TEXT
+) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT md5(concat_ws(
+        chr(31),
+        COALESCE(mrn, ''),
+        COALESCE(first_name, ''),
+        COALESCE(last_name, ''),
+        COALESCE(birth_date, ''),
+        COALESCE(visit_account_number, ''),
+        COALESCE(visit_date, ''),
+        COALESCE(reason, '')
+    ))
+$$;
+
+CREATE TABLE IF NOT EXISTS visit_row_hashes (
+    visit_account_number VARCHAR(300) PRIMARY KEY,
+    row_hash TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
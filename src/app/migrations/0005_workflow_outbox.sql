@@ -0,0 +1,15 @@
+-- Workflow starts requested by the API, written in the same transaction as
+-- the ingestion and handed to Temporal by the outbox dispatcher. Rows are
+-- deleted once the start succeeded; failed starts are retried from
+-- available_at with exponential backoff.
+CREATE TABLE IF NOT EXISTS workflow_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    ingestion_id INT NOT NULL REFERENCES ingestions(id) ON DELETE CASCADE,
+    attempts INT NOT NULL DEFAULT 0,
+    available_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_workflow_outbox_available_at
+    ON workflow_outbox (available_at, id);
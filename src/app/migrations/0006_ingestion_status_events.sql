@@ -0,0 +1,22 @@
+-- Publishes every ingestion status change on the ingestion_status channel
+-- as {"id": ..., "status": ...}, whichever code path made it. Delivered when
+-- the changing transaction commits.
+CREATE OR REPLACE FUNCTION notify_ingestion_status() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.status IS NOT DISTINCT FROM NEW.status THEN
+        RETURN NULL;
+    END IF;
+    PERFORM pg_notify(
+        'ingestion_status',
+        json_build_object('id', NEW.id, 'status', NEW.status)::text
+    );
+    RETURN NULL;
+END
+$$;
+
+DROP TRIGGER IF EXISTS ingestions_status_notify ON ingestions;
+CREATE TRIGGER ingestions_status_notify
+    AFTER INSERT OR UPDATE OF status ON ingestions
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_ingestion_status();
@@ -0,0 +1,51 @@
+-- Name search index for /patients/search: every person's first and last
+-- name split into case- and accent-folded tokens. Kept up to date by the
+-- ingestion through refresh_person_name_tokens().
+CREATE EXTENSION IF NOT EXISTS unaccent;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- unaccent() is only STABLE (it depends on the search path); with the
+-- dictionary spelled out the result is fixed, so the wrapper can be IMMUTABLE
+CREATE OR REPLACE FUNCTION fold_name(name TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS $$
+    SELECT lower(public.unaccent('public.unaccent'::regdictionary, name))
+$$;
+
+CREATE OR REPLACE FUNCTION name_tokens(name TEXT) RETURNS SETOF TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT DISTINCT token
+    FROM regexp_split_to_table(fold_name(name), '[^[:alnum:]]+') AS token
+    WHERE token <> ''
+$$;
+
+-- "C" collation: the primary key orders tokens bytewise, which is what the
+-- prefix range scans rely on
+CREATE TABLE IF NOT EXISTS person_name_tokens (
+    token TEXT COLLATE "C" NOT NULL,
+    person_id INT NOT NULL REFERENCES persons(id) ON DELETE CASCADE,
+    PRIMARY KEY (token, person_id)
+);
+
+CREATE INDEX IF NOT EXISTS person_name_tokens_person_id_idx
+    ON person_name_tokens (person_id);
+
+CREATE OR REPLACE FUNCTION refresh_person_name_tokens(person_ids INT[]) RETURNS void
+LANGUAGE sql AS $$
+    DELETE FROM person_name_tokens WHERE person_id = ANY(person_ids);
+    INSERT INTO person_name_tokens (token, person_id)
+    SELECT DISTINCT t.token, pe.id
+    FROM persons pe,
+        name_tokens(concat_ws(' ', pe.first_name, pe.last_name)) AS t(token)
+    WHERE pe.id = ANY(person_ids)
+    ON CONFLICT DO NOTHING;
+$$;
+
+INSERT INTO person_name_tokens (token, person_id)
+SELECT DISTINCT t.token, pe.id
+FROM persons pe,
+    name_tokens(concat_ws(' ', pe.first_name, pe.last_name)) AS t(token)
+ON CONFLICT DO NOTHING;
+
+-- Trigram index for fuzzy matching; built after the backfill
+CREATE INDEX IF NOT EXISTS person_name_tokens_trgm_idx
+    ON person_name_tokens USING gin (token gin_trgm_ops);
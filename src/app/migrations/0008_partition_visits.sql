@@ -0,0 +1,108 @@
+-- Range-partitions visits by month of visit_date. Unique indexes on a
+-- partitioned table must contain the partition key, so the uniqueness of
+-- visit_account_number moves to the visit_account_numbers registry: the
+-- ingestion registers an account number first and only inserts the visit
+-- when it was new. The registry also records where (which visit_date) the
+-- visit lives, so a lookup by account number can be pruned.
+--
+-- The existing rows are copied into the new table; on a large table this
+-- migration takes a while and blocks writes to visits until it commits.
+
+-- Creates the monthly partitions (visits_YYYY_MM) for the given dates that
+-- do not have one yet; returns how many it created
+CREATE OR REPLACE FUNCTION ensure_visit_partitions(dates DATE[]) RETURNS INT
+LANGUAGE plpgsql AS $$
+DECLARE
+    month DATE;
+    partition_name TEXT;
+    created INT := 0;
+BEGIN
+    FOR month IN
+        SELECT DISTINCT date_trunc('month', d)::DATE
+        FROM unnest(dates) AS d
+        WHERE d IS NOT NULL
+        ORDER BY 1
+    LOOP
+        partition_name := 'visits_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE 'CREATE TABLE ' || quote_ident(partition_name)
+                || ' PARTITION OF visits FOR VALUES FROM ('
+                || quote_literal(month) || ') TO ('
+                || quote_literal((month + INTERVAL '1 month')::DATE) || ')';
+            created := created + 1;
+        END IF;
+    END LOOP;
+    RETURN created;
+END
+$$;
+
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'visits'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE visits RENAME TO visits_unpartitioned;
+    ALTER TABLE visits_unpartitioned RENAME CONSTRAINT visits_pkey TO visits_unpartitioned_pkey;
+    -- Keep the id sequence when the old table is dropped
+    ALTER SEQUENCE visits_id_seq OWNED BY NONE;
+
+    CREATE TABLE visits (
+        id INT NOT NULL DEFAULT nextval('visits_id_seq'),
+        visit_account_number VARCHAR(300),
+        patient_id INT NOT NULL,
+        visit_date DATE NOT NULL,
+        reason TEXT,
+        PRIMARY KEY (id, visit_date)
+    ) PARTITION BY RANGE (visit_date);
+    ALTER SEQUENCE visits_id_seq OWNED BY visits.id;
+
+    PERFORM ensure_visit_partitions(
+        ARRAY(SELECT DISTINCT date_trunc('month', visit_date)::DATE FROM visits_unpartitioned)
+    );
+
+    INSERT INTO visits (id, visit_account_number, patient_id, visit_date, reason)
+    SELECT id, visit_account_number, patient_id, visit_date, reason
+    FROM visits_unpartitioned;
+
+    DROP TABLE visits_unpartitioned;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS visit_account_numbers (
+    visit_account_number VARCHAR(300) PRIMARY KEY,
+    visit_date DATE NOT NULL
+);
+
+INSERT INTO visit_account_numbers (visit_account_number, visit_date)
+SELECT visit_account_number, visit_date
+FROM visits
+WHERE visit_account_number IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+-- Recreated on the partitioned table (they were dropped with the old one)
+CREATE INDEX IF NOT EXISTS visits_patient_id_visit_date_idx
+    ON visits (patient_id, visit_date DESC, id DESC);
+
+CREATE INDEX IF NOT EXISTS visits_visit_account_number_idx
+    ON visits (visit_account_number);
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conname = 'patient_entry' AND conrelid = 'visits'::regclass
+    ) THEN
+        ALTER TABLE visits
+            ADD CONSTRAINT patient_entry FOREIGN KEY (patient_id)
+                REFERENCES patients (id) MATCH SIMPLE
+                ON UPDATE CASCADE
+                ON DELETE CASCADE;
+    END IF;
+END
+$$;
+
+-- The current month and the next few, so ingestion rarely has to create one
+SELECT ensure_visit_partitions(
+    ARRAY(SELECT generate_series(date_trunc('month', NOW()), NOW() + INTERVAL '3 months', INTERVAL '1 month')::DATE)
+);
@@ -0,0 +1,44 @@
+-- Two ingestions creating the same month at once could both see it missing
+-- and the second CREATE TABLE failed with duplicate_table. Partition creation
+-- is now serialized by a transaction-level advisory lock, taken only when a
+-- month is missing and followed by a re-check; a partition created by a
+-- session that does not take the lock is still tolerated.
+CREATE OR REPLACE FUNCTION ensure_visit_partitions(dates DATE[]) RETURNS INT
+LANGUAGE plpgsql AS $$
+DECLARE
+    month DATE;
+    partition_name TEXT;
+    created INT := 0;
+    locked BOOLEAN := false;
+BEGIN
+    FOR month IN
+        SELECT DISTINCT date_trunc('month', d)::DATE
+        FROM unnest(dates) AS d
+        WHERE d IS NOT NULL
+        ORDER BY 1
+    LOOP
+        partition_name := 'visits_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NOT NULL THEN
+            CONTINUE;
+        END IF;
+        IF NOT locked THEN
+            -- Arbitrary key, held until the caller's transaction ends
+            PERFORM pg_advisory_xact_lock(720431002);
+            locked := true;
+            IF to_regclass(partition_name) IS NOT NULL THEN
+                CONTINUE;
+            END IF;
+        END IF;
+        BEGIN
+            EXECUTE 'CREATE TABLE ' || quote_ident(partition_name)
+                || ' PARTITION OF visits FOR VALUES FROM ('
+                || quote_literal(month) || ') TO ('
+                || quote_literal((month + INTERVAL '1 month')::DATE) || ')';
+            created := created + 1;
+        EXCEPTION WHEN duplicate_table THEN
+            NULL;
+        END;
+    END LOOP;
+    RETURN created;
+END
+$$;
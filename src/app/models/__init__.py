@@ -1,5 +1,8 @@
 from .ingestitem import IngestItem
+from .ingestionstatus import MAX_STATUS_IDS, IngestionStatusRequest
 
 __all__ = [
     "IngestItem",
-]
\ No newline at end of file
+    "IngestionStatusRequest",
+    "MAX_STATUS_IDS",
+]
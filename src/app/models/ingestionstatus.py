@@ -0,0 +1,9 @@
+from typing import List
+
+from pydantic import BaseModel, Field
+
+# Upper bound on the ids looked up by one request
+MAX_STATUS_IDS = 1000
+
+class IngestionStatusRequest(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=MAX_STATUS_IDS)
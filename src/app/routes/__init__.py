@@ -1,9 +1,13 @@
 from .health import router as health_router
+from .ingestions import router as ingestions_router
 from .inputs import router as inputs_router
+from .metrics import router as metrics_router
 from .patients import router as patients_router
 
 routes = [
     health_router,
+    ingestions_router,
     inputs_router,
+    metrics_router,
     patients_router,
 ]
\ No newline at end of file
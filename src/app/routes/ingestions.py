@@ -0,0 +1,113 @@
+import asyncio
+import json
+from os import getenv
+from typing import AsyncIterator, List
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import MAX_STATUS_IDS, IngestionStatusRequest
+from services.database import AsyncSessionLocal, get_async_db
+from services.ingestion_events import FINAL_STATUSES, status_broker
+
+router = APIRouter(tags=["ingestions"])
+
+# Comment lines sent on idle streams so proxies keep them open
+KEEPALIVE_SECONDS = float(getenv("STATUS_EVENTS_KEEPALIVE_SECONDS", "15"))
+
+async def _load_statuses(db: AsyncSession, ids: List[int]) -> List[dict]:
+    rows = await db.execute(
+        text(
+            """
+            SELECT id, status, created_at, csv_filename, s3_path
+            FROM ingestions
+            WHERE id = ANY(:ids)
+            ORDER BY id
+            """
+        ),
+        {"ids": ids},
+    )
+    return [dict(r) for r in rows.mappings()]
+
+def _sse(event: dict) -> str:
+    return f"event: status\ndata: {json.dumps(event)}\n\n"
+
+async def _status_events(ids: List[int]) -> AsyncIterator[str]:
+    # Subscribed before the statuses are loaded, so no change can fall
+    # between the two
+    subscription = status_broker.subscribe()
+    try:
+        sent = {}
+        pending = set(ids)
+
+        async def load() -> List[dict]:
+            async with AsyncSessionLocal() as db:
+                current = await _load_statuses(db, ids)
+            return [{"id": row["id"], "status": row["status"]} for row in current]
+
+        events = await load()
+        # Unknown ids are reported once and not waited for
+        for missing in sorted(pending - {event["id"] for event in events}):
+            pending.discard(missing)
+            yield _sse({"id": missing, "status": None})
+
+        while True:
+            for event in events:
+                if event["id"] not in pending or sent.get(event["id"]) == event["status"]:
+                    continue
+                sent[event["id"]] = event["status"]
+                yield _sse(event)
+                if event["status"] in FINAL_STATUSES:
+                    pending.discard(event["id"])
+            if not pending:
+                return
+
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                events = []
+                continue
+            events = [event] if event is not None else []
+            if subscription.stale:
+                subscription.stale = False
+                events += await load()
+    finally:
+        status_broker.unsubscribe(subscription)
+
+# Server-sent events: the current status of every requested ingestion, then
+# each change as it is committed. The stream ends once all of them are
+# ingested; unknown ids are reported once with a null status.
+@router.get("/ingestions/events")
+async def ingestion_events(
+    ids: List[int] = Query(..., min_length=1, max_length=MAX_STATUS_IDS),
+) -> StreamingResponse:
+    return StreamingResponse(
+        _status_events(list(dict.fromkeys(ids))),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.post("/ingestions/status")
+async def ingestion_statuses(
+    body: IngestionStatusRequest,
+    db: AsyncSession = Depends(get_async_db),
+) -> dict:
+    ingestions = await _load_statuses(db, body.ids)
+    found = {row["id"] for row in ingestions}
+    return {
+        "ingestions": ingestions,
+        "missing": [i for i in dict.fromkeys(body.ids) if i not in found],
+    }
+
+@router.get("/ingestions/{ingestion_id}")
+async def get_ingestion(
+    ingestion_id: int,
+    db: AsyncSession = Depends(get_async_db),
+) -> dict:
+    ingestions = await _load_statuses(db, [ingestion_id])
+    if not ingestions:
+        raise HTTPException(status_code=404, detail="Ingestion not found")
+    return ingestions[0]
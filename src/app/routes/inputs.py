@@ -1,61 +1,164 @@
+import csv
 import hashlib
-import json
-from services.temporal import start_csv_conversion
-from typing import List
+import io
+from asyncio import to_thread
+from uuid import uuid4
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
 from sqlalchemy import text
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from services.database import get_db
+from services.csvio import CSV_HEADERS
+from services.database import get_async_db
+from services.outbox import enqueue_conversion
+from services.s3 import StreamingUpload, delete_object
+from services.uploads import (
+    PayloadHasher,
+    canonical_payload,
+    csv_records,
+    ndjson_records,
+    normalize_item,
+)
 from models import IngestItem
 
 router = APIRouter(tags=["ingestion"])
 
-@router.post("/ingest")
+# The body is validated straight from the raw bytes by canonical_payload
+# rather than by FastAPI, so its schema is declared here for the docs
+INGEST_BODY_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {
+                "schema": {"type": "array", "items": IngestItem.model_json_schema()},
+            },
+        },
+    },
+}
+
+@router.post("/ingest", openapi_extra=INGEST_BODY_SCHEMA)
 async def ingest(
-    payload: List[IngestItem],
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
 ) -> dict:
     # Serialize the validated payload in a deterministic way for hashing
-    normalized_payload = [
-        {
-            "mrn": item.mrn,
-            "first_name": item.first_name,
-            "last_name": item.last_name,
-            "birth_date": item.birth_date.isoformat(),
-            "visit_account_number": item.visit_account_number,
-            "visit_date": item.visit_date.isoformat(),
-            "reason": item.reason,
-        }
-        for item in payload
-    ]
-    payload_str = json.dumps(normalized_payload, sort_keys=True, separators=(",", ":"))
+    payload_str = canonical_payload(await request.body())
     md5_hash = hashlib.md5(payload_str.encode("utf-8")).hexdigest()
 
     # Check if this payload already exists
-    existing_id = db.execute(
-        text("SELECT id FROM ingestions WHERE md5_hash = :md5_hash"),
-        {"md5_hash": md5_hash},
+    existing_id = (
+        await db.execute(
+            text("SELECT id FROM ingestions WHERE md5_hash = :md5_hash"),
+            {"md5_hash": md5_hash},
+        )
     ).scalar()
 
     if existing_id is not None:
-        await start_csv_conversion(existing_id)
+        await enqueue_conversion(db, existing_id)
+        await db.commit()
         return {"id": existing_id, "status": "existing"}
 
     # Insert new record
-    new_id = db.execute(
-        text(
-            """
-            INSERT INTO ingestions (payload, md5_hash)
-            VALUES ( :payload, :md5_hash)
-            RETURNING id
-            """
-        ),
-        {"payload": payload_str, "md5_hash": md5_hash},
+    new_id = (
+        await db.execute(
+            text(
+                """
+                INSERT INTO ingestions (payload, md5_hash)
+                VALUES ( :payload, :md5_hash)
+                RETURNING id
+                """
+            ),
+            {"payload": payload_str, "md5_hash": md5_hash},
+        )
+    ).scalar()
+    # The workflow is started by the outbox dispatcher once this commits
+    await enqueue_conversion(db, new_id)
+    await db.commit()
+
+    return {"id": new_id, "status": "created"}
+
+STREAM_PARSERS = {
+    "application/x-ndjson": ndjson_records,
+    "application/jsonl": ndjson_records,
+    "text/csv": csv_records,
+}
+
+# Same records as /ingest, sent as NDJSON (one object per line) or CSV with a
+# header row. Rows are validated and written to the S3 CSV as they arrive, so
+# the body is never held in memory nor stored in ingestions.payload.
+@router.post("/ingest/stream")
+async def ingest_stream(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+) -> dict:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    parse = STREAM_PARSERS.get(content_type)
+    if parse is None:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported content type, expected one of {', '.join(STREAM_PARSERS)}",
+        )
+
+    upload = StreamingUpload(f"upload_{uuid4().hex}.csv")
+    hasher = PayloadHasher()
+    text_buffer = io.StringIO()
+    writer = csv.writer(text_buffer)
+    writer.writerow(CSV_HEADERS)
+    rows = 0
+
+    try:
+        async for line, record in parse(request.stream()):
+            try:
+                item = normalize_item(IngestItem.model_validate(record))
+            except ValidationError as e:
+                raise RequestValidationError(
+                    [{**error, "loc": ("body", line, *error["loc"])} for error in e.errors()]
+                )
+
+            hasher.update(item)
+            writer.writerow([item[column] for column in CSV_HEADERS])
+            await upload.write(text_buffer.getvalue().encode("utf-8"))
+            text_buffer.seek(0)
+            text_buffer.truncate()
+            rows += 1
+
+        await upload.write(text_buffer.getvalue().encode("utf-8"))
+        s3_path = await upload.close()
+    except BaseException:
+        await upload.abort()
+        raise
+
+    md5_hash = hasher.hexdigest()
+    new_id = (
+        await db.execute(
+            text(
+                """
+                INSERT INTO ingestions (md5_hash, status, csv_filename, s3_path)
+                VALUES (:md5_hash, 'uploaded', :filename, :s3_path)
+                ON CONFLICT (md5_hash) DO NOTHING
+                RETURNING id
+                """
+            ),
+            {"md5_hash": md5_hash, "filename": upload.filename, "s3_path": s3_path},
+        )
     ).scalar()
-    db.commit()
 
-    await start_csv_conversion(new_id)
+    if new_id is None:
+        existing_id = (
+            await db.execute(
+                text("SELECT id FROM ingestions WHERE md5_hash = :md5_hash"),
+                {"md5_hash": md5_hash},
+            )
+        ).scalar()
+        await enqueue_conversion(db, existing_id)
+        await db.commit()
+        # Same content was ingested before; the new object is not needed
+        await to_thread(delete_object, s3_path)
+        return {"id": existing_id, "status": "existing", "rows": rows}
+
+    await enqueue_conversion(db, new_id)
+    await db.commit()
 
-    return {"id": new_id, "status": "created"}
\ No newline at end of file
+    return {"id": new_id, "status": "created", "rows": rows}
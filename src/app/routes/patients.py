@@ -1,20 +1,76 @@
-from typing import Optional
+from datetime import date
+from os import getenv
+from typing import Dict, List, Literal, Optional
 
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 
+from services.cache import patient_cache, patient_tag
 from services.database import get_db
+from services.pagination import InvalidCursor, decode_cursor, encode_cursor, estimate_count
 
 router = APIRouter(tags=["ingestion"])
 
-@router.get("/patients/{patient_id}")
-def getPatient(
-    patient_id: int,
-    visits_page: int = Query(1, ge=1),
-    visits_page_size: int = Query(10, ge=1, le=100),
-    db: Session = Depends(get_db),
-) -> dict:
+RECENT_VISITS_LIMIT = 10
+
+# How totals are reported: exact COUNT(*), planner estimate, or not at all
+CountMode = Literal["exact", "estimated", "none"]
+
+def _recent_visits(
+    db: Session, patient_ids: List[int], limit: int = RECENT_VISITS_LIMIT
+) -> Dict[int, List[dict]]:
+    visits_by_patient = {patient_id: [] for patient_id in patient_ids}
+    if not patient_ids:
+        return visits_by_patient
+
+    # One round-trip for the whole page; ROW_NUMBER keeps the most recent
+    # visits of each patient
+    rows = db.execute(
+        text(
+            """
+            SELECT patient_id, id, visit_account_number, visit_date, reason
+            FROM (
+                SELECT
+                    patient_id,
+                    id,
+                    visit_account_number,
+                    visit_date,
+                    reason,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY patient_id
+                        ORDER BY visit_date DESC, id DESC
+                    ) AS visit_rank
+                FROM visits
+                WHERE patient_id = ANY(:patient_ids)
+            ) v
+            WHERE visit_rank <= :limit
+            ORDER BY patient_id, visit_rank
+            """
+        ),
+        {"patient_ids": patient_ids, "limit": limit},
+    ).mappings().all()
+
+    for row in rows:
+        visit = dict(row)
+        visits_by_patient[visit.pop("patient_id")].append(visit)
+
+    return visits_by_patient
+
+def _count(db: Session, mode: str, query: str, params: dict) -> Optional[int]:
+    if mode == "none":
+        return None
+    if mode == "estimated":
+        return estimate_count(db, query, params)
+    return db.execute(text(f"SELECT COUNT(*) FROM ({query}) c"), params).scalar()
+
+def _decode_cursor(cursor: str, fields: dict) -> dict:
+    try:
+        return decode_cursor(cursor, fields)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _patient_header(db: Session, patient_id: int) -> Optional[dict]:
     row = db.execute(
         text(
             """
@@ -34,40 +90,226 @@ def getPatient(
     ).mappings().first()
 
     if row is None:
-        from fastapi import HTTPException
-        raise HTTPException(status_code=404, detail="Patient not found")
+        return None
+
+    return {
+        "id": row["id"],
+        "mrn": row["mrn"],
+        "first_name": row["first_name"],
+        "last_name": row["last_name"],
+        "birth_date": str(row["birth_date"]) if row["birth_date"] else None,
+        "created_at": str(row["created_at"]) if row["created_at"] else None,
+    }
 
-    visits_total = db.execute(
-        text("SELECT COUNT(*) FROM visits WHERE patient_id = :patient_id"),
-        {"patient_id": patient_id},
-    ).scalar()
+def _patient_visits(
+    db: Session,
+    patient_id: int,
+    visits_page: int,
+    visits_page_size: int,
+    visits_cursor: Optional[str],
+    visits_count: str,
+    visit_date_from: Optional[date] = None,
+    visit_date_to: Optional[date] = None,
+) -> dict:
+    params = {"patient_id": patient_id}
 
-    visits_offset = (visits_page - 1) * visits_page_size
+    # visits is partitioned by visit_date, so a date range limits both
+    # queries to the partitions it overlaps
+    date_range = ""
+    if visit_date_from is not None:
+        date_range += " AND visit_date >= :visit_date_from"
+        params["visit_date_from"] = visit_date_from
+    if visit_date_to is not None:
+        date_range += " AND visit_date <= :visit_date_to"
+        params["visit_date_to"] = visit_date_to
+
+    visits_total = _count(
+        db,
+        visits_count,
+        f"SELECT 1 FROM visits WHERE patient_id = :patient_id{date_range}",
+        params,
+    )
+
+    # Keyset pagination on (visit_date, id) when a cursor is given, so deep
+    # pages cost the same as the first one
+    if visits_cursor is not None:
+        after = _decode_cursor(
+            visits_cursor, {"visit_date": date.fromisoformat, "id": int}
+        )
+        keyset = "AND (visit_date, id) < (:after_visit_date, :after_id)"
+        params.update(after_visit_date=after["visit_date"], after_id=after["id"])
+        visits_offset = 0
+    else:
+        keyset = ""
+        visits_offset = (visits_page - 1) * visits_page_size
 
     visits = db.execute(
         text(
-            """
+            f"""
             SELECT id, visit_account_number, visit_date, reason
             FROM visits
-            WHERE patient_id = :patient_id
-            ORDER BY visit_date DESC
+            WHERE patient_id = :patient_id{date_range}
+            {keyset}
+            ORDER BY visit_date DESC, id DESC
             LIMIT :limit OFFSET :offset
             """
         ),
-        {"patient_id": patient_id, "limit": visits_page_size, "offset": visits_offset},
+        {**params, "limit": visits_page_size + 1, "offset": visits_offset},
     ).mappings().all()
 
+    visits_next_cursor = None
+    if len(visits) > visits_page_size:
+        visits = visits[:visits_page_size]
+        last = visits[-1]
+        visits_next_cursor = encode_cursor(
+            {"visit_date": last["visit_date"].isoformat(), "id": last["id"]}
+        )
+
     return {
-        "id": row["id"],
-        "mrn": row["mrn"],
-        "first_name": row["first_name"],
-        "last_name": row["last_name"],
-        "birth_date": str(row["birth_date"]) if row["birth_date"] else None,
-        "created_at": str(row["created_at"]) if row["created_at"] else None,
         "visits": [dict(v) for v in visits],
+        "visits_total": visits_total,
+        "visits_next_cursor": visits_next_cursor,
+    }
+
+# Candidates taken per query token before ranking, so a one-letter prefix
+# cannot pull in every person
+SEARCH_CANDIDATES = int(getenv("SEARCH_CANDIDATES", "1000"))
+
+# Ranked name lookup on person_name_tokens. Every query token has to match a
+# name token exactly (1.0), as a prefix (0.75) or, from three characters on,
+# by trigram similarity (up to 0.5); patients are ranked by the sum.
+# Declared before /patients/{patient_id}, which would otherwise match it.
+@router.get("/patients/search")
+def searchPatients(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+) -> dict:
+    rows = db.execute(
+        text(
+            """
+            WITH query AS (
+                SELECT token FROM name_tokens(:q) AS token
+            ),
+            matches AS (
+                SELECT m.person_id, query.token, MAX(m.score) AS score
+                FROM query
+                CROSS JOIN LATERAL (
+                    (
+                        SELECT person_id, CASE WHEN t.token = query.token THEN 1.0 ELSE 0.75 END AS score
+                        FROM person_name_tokens t
+                        WHERE t.token >= query.token
+                          AND t.token < query.token || chr(1114111)
+                        ORDER BY t.token
+                        LIMIT :candidates
+                    )
+                    UNION ALL
+                    (
+                        SELECT person_id, 0.5 * similarity(t.token, query.token)
+                        FROM person_name_tokens t
+                        WHERE length(query.token) >= 3
+                          AND t.token % query.token
+                        LIMIT :candidates
+                    )
+                ) m
+                GROUP BY m.person_id, query.token
+            ),
+            ranked AS (
+                SELECT person_id, SUM(score) AS score
+                FROM matches
+                GROUP BY person_id
+                HAVING COUNT(*) = (SELECT COUNT(*) FROM query)
+                ORDER BY score DESC, person_id
+                LIMIT :limit
+            )
+            SELECT
+                p.id,
+                p.mrn,
+                pe.first_name,
+                pe.last_name,
+                pe.birth_date,
+                r.score
+            FROM ranked r
+            JOIN patients p ON p.id = r.person_id
+            JOIN persons pe ON pe.id = p.id
+            ORDER BY r.score DESC, p.id
+            """
+        ),
+        {"q": q, "limit": limit, "candidates": SEARCH_CANDIDATES},
+    ).mappings().all()
+
+    return {
+        "patients": [
+            {
+                "id": row["id"],
+                "mrn": row["mrn"],
+                "first_name": row["first_name"],
+                "last_name": row["last_name"],
+                "birth_date": str(row["birth_date"]) if row["birth_date"] else None,
+                "score": round(float(row["score"]), 4),
+            }
+            for row in rows
+        ],
+        "limit": limit,
+    }
+
+@router.get("/patients/{patient_id}")
+def getPatient(
+    patient_id: int,
+    visits_page: int = Query(1, ge=1),
+    visits_page_size: int = Query(10, ge=1, le=100),
+    visits_cursor: Optional[str] = Query(None),
+    visits_count: CountMode = Query("exact"),
+    visit_date_from: Optional[date] = Query(None),
+    visit_date_to: Optional[date] = Query(None),
+    db: Session = Depends(get_db),
+) -> dict:
+    if visit_date_from is not None and visit_date_to is not None and visit_date_from > visit_date_to:
+        raise HTTPException(status_code=400, detail="visit_date_from is after visit_date_to")
+
+    # Both parts are cached until the ingestion touches this patient again
+    tags = [patient_tag(patient_id)]
+
+    header = patient_cache.get_or_load(
+        ("patient", patient_id),
+        tags,
+        lambda: _patient_header(db, patient_id),
+    )
+
+    if header is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+
+    visits = patient_cache.get_or_load(
+        (
+            "patient_visits",
+            patient_id,
+            visits_page,
+            visits_page_size,
+            visits_cursor,
+            visits_count,
+            visit_date_from,
+            visit_date_to,
+        ),
+        tags,
+        lambda: _patient_visits(
+            db,
+            patient_id,
+            visits_page,
+            visits_page_size,
+            visits_cursor,
+            visits_count,
+            visit_date_from,
+            visit_date_to,
+        ),
+    )
+
+    return {
+        **header,
+        "visits": visits["visits"],
         "visits_page": visits_page,
         "visits_page_size": visits_page_size,
-        "visits_total": visits_total,
+        "visits_total": visits["visits_total"],
+        "visits_next_cursor": visits["visits_next_cursor"],
     }
 
 @router.get("/patients")
@@ -77,6 +319,8 @@ def listPatients(
     last_name: Optional[str] = Query(None),
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    count: CountMode = Query("exact"),
     db: Session = Depends(get_db),
 ) -> dict:
     conditions = []
@@ -93,20 +337,29 @@ def listPatients(
         params["last_name"] = f"%{last_name}%"
 
     where_clause = "WHERE " + " AND ".join(conditions) if conditions else ""
-    offset = (page - 1) * page_size
 
-    total = db.execute(
-        text(
-            f"""
-            SELECT COUNT(*) FROM patients p
-            LEFT JOIN persons pe ON pe.id = p.id
-            {where_clause}
-            """
-        ),
+    total = _count(
+        db,
+        count,
+        f"""
+        SELECT 1 FROM patients p
+        LEFT JOIN persons pe ON pe.id = p.id
+        {where_clause}
+        """,
         params,
-    ).scalar()
+    )
+
+    # Keyset pagination on p.id when a cursor is given
+    if cursor is not None:
+        after = _decode_cursor(cursor, {"id": int})
+        conditions.append("p.id > :after_id")
+        params["after_id"] = after["id"]
+        where_clause = "WHERE " + " AND ".join(conditions)
+        offset = 0
+    else:
+        offset = (page - 1) * page_size
 
-    params["limit"] = page_size
+    params["limit"] = page_size + 1
     params["offset"] = offset
 
     rows = db.execute(
@@ -129,36 +382,30 @@ def listPatients(
         params,
     ).mappings().all()
 
-    patients = []
-    for row in rows:
-        visits = db.execute(
-            text(
-                """
-                SELECT id, visit_account_number, visit_date, reason
-                FROM visits
-                WHERE patient_id = :patient_id
-                ORDER BY visit_date DESC
-                LIMIT 10
-                """
-            ),
-            {"patient_id": row["id"]},
-        ).mappings().all()
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor({"id": rows[-1]["id"]})
 
-        patients.append(
-            {
-                "id": row["id"],
-                "mrn": row["mrn"],
-                "first_name": row["first_name"],
-                "last_name": row["last_name"],
-                "birth_date": str(row["birth_date"]) if row["birth_date"] else None,
-                "created_at": str(row["created_at"]) if row["created_at"] else None,
-                "visits": [dict(v) for v in visits],
-            }
-        )
+    visits_by_patient = _recent_visits(db, [row["id"] for row in rows])
+
+    patients = [
+        {
+            "id": row["id"],
+            "mrn": row["mrn"],
+            "first_name": row["first_name"],
+            "last_name": row["last_name"],
+            "birth_date": str(row["birth_date"]) if row["birth_date"] else None,
+            "created_at": str(row["created_at"]) if row["created_at"] else None,
+            "visits": visits_by_patient[row["id"]],
+        }
+        for row in rows
+    ]
 
     return {
         "patients": patients,
         "page": page,
         "page_size": page_size,
         "total": total,
+        "next_cursor": next_cursor,
     }
@@ -0,0 +1,189 @@
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from os import getenv
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+CACHE_BACKEND = getenv("CACHE_BACKEND", "memory")
+CACHE_URL = getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_TTL_SECONDS = float(getenv("CACHE_TTL_SECONDS", "60"))
+CACHE_MAX_ENTRIES = int(getenv("CACHE_MAX_ENTRIES", "10000"))
+
+# Channel the ingestion activity notifies with the ids of upserted patients
+PATIENT_CHANGES_CHANNEL = "patient_changes"
+
+
+def patient_tag(patient_id: int) -> str:
+    return f"patient:{patient_id}"
+
+
+class Cache(ABC):
+    @abstractmethod
+    def get(self, key: Hashable) -> Optional[Any]:
+        ...
+
+    @abstractmethod
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = ()) -> None:
+        ...
+
+    @abstractmethod
+    def invalidate(self, tags: Iterable[str]) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+    # Bumped by every invalidation; a value loaded while it changed may
+    # already be stale and is not stored
+    @abstractmethod
+    def generation(self) -> int:
+        ...
+
+    def get_or_load(
+        self,
+        key: Hashable,
+        tags: Iterable[str],
+        loader: Callable[[], Optional[Any]],
+    ) -> Optional[Any]:
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        generation = self.generation()
+        value = loader()
+        if value is not None and self.generation() == generation:
+            self.set(key, value, tags)
+        return value
+
+
+class NullCache(Cache):
+    def get(self, key: Hashable) -> Optional[Any]:
+        return None
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = ()) -> None:
+        pass
+
+    def invalidate(self, tags: Iterable[str]) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+    def generation(self) -> int:
+        return 0
+
+
+# In-process LRU with a per-entry TTL and tag based invalidation
+class MemoryCache(Cache):
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL_SECONDS) -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._tags: dict = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = ()) -> None:
+        tags = tuple(tags)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self._ttl, value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self._max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, tags: Iterable[str]) -> None:
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._tags.clear()
+
+    def generation(self) -> int:
+        return self._generation
+
+
+# Shared cache for multiple API replicas. Values are stored as JSON, tags as
+# Redis sets of the keys carrying them.
+class RedisCache(Cache):
+    def __init__(self, url: str = CACHE_URL, ttl: float = CACHE_TTL_SECONDS) -> None:
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._ttl = int(ttl)
+
+    def _key(self, key: Hashable) -> str:
+        return "cache:" + json.dumps(key, default=str, separators=(",", ":"))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        raw = self._redis.get(self._key(key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = ()) -> None:
+        cache_key = self._key(key)
+        pipe = self._redis.pipeline()
+        pipe.set(cache_key, json.dumps(value, default=str), ex=self._ttl)
+        for tag in tags:
+            pipe.sadd(f"tag:{tag}", cache_key)
+            pipe.expire(f"tag:{tag}", self._ttl)
+        pipe.execute()
+
+    def invalidate(self, tags: Iterable[str]) -> None:
+        pipe = self._redis.pipeline()
+        for tag in tags:
+            keys = self._redis.smembers(f"tag:{tag}")
+            if keys:
+                pipe.delete(*keys)
+            pipe.delete(f"tag:{tag}")
+        pipe.incr("cache-generation")
+        pipe.execute()
+
+    def clear(self) -> None:
+        for key in self._redis.scan_iter("cache:*"):
+            self._redis.delete(key)
+        self._redis.incr("cache-generation")
+
+    def generation(self) -> int:
+        return int(self._redis.get("cache-generation") or 0)
+
+
+def create_cache(backend: str = CACHE_BACKEND) -> Cache:
+    if backend == "none":
+        return NullCache()
+    if backend == "redis":
+        return RedisCache()
+    return MemoryCache()
+
+
+patient_cache = create_cache()
@@ -0,0 +1,93 @@
+import csv
+import io
+import zlib
+from itertools import islice
+from typing import Iterable, Optional, Sequence
+
+CSV_HEADERS = [
+    "mrn",
+    "first_name",
+    "last_name",
+    "birth_date",
+    "visit_account_number",
+    "visit_date",
+    "reason",
+]
+
+
+# Removes and returns up to `size` bytes (all of them when negative) from the
+# front of a read-ahead buffer; shared by the read() of the streams here and
+# in services.s3
+def take(pending: bytearray, size: int) -> bytes:
+    if size < 0 or size >= len(pending):
+        data = bytes(pending)
+        pending.clear()
+    else:
+        data = bytes(pending[:size])
+        del pending[:size]
+    return data
+
+
+# Read-only file object that encodes rows as CSV bytes on demand, so the
+# whole CSV never has to be materialized in memory or on disk.
+class CsvRowStream:
+    def __init__(
+        self,
+        rows: Iterable[Sequence],
+        header: Optional[Sequence[str]] = None,
+        batch_size: int = 1000,
+    ) -> None:
+        self._rows = iter(rows)
+        self._batch_size = batch_size
+        self._text = io.StringIO()
+        self._writer = csv.writer(self._text)
+        self._pending = bytearray()
+        self._exhausted = False
+        if header is not None:
+            self._writer.writerow(header)
+            self._drain_text()
+
+    def readable(self) -> bool:
+        return True
+
+    def _drain_text(self) -> None:
+        self._pending += self._text.getvalue().encode("utf-8")
+        self._text.seek(0)
+        self._text.truncate()
+
+    def _fill(self, size: int) -> None:
+        while not self._exhausted and (size < 0 or len(self._pending) < size):
+            batch = list(islice(self._rows, self._batch_size))
+            if not batch:
+                self._exhausted = True
+                break
+            self._writer.writerows(batch)
+            self._drain_text()
+
+    def read(self, size: int = -1) -> bytes:
+        self._fill(size)
+        return take(self._pending, size)
+
+
+# Wraps a readable stream and hands out its content gzip-compressed.
+class GzipReadStream:
+    def __init__(self, source, read_size: int = 256 * 1024) -> None:
+        self._source = source
+        self._read_size = read_size
+        self._compressor = zlib.compressobj(wbits=31)
+        self._pending = bytearray()
+        self._exhausted = False
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._exhausted and (size < 0 or len(self._pending) < size):
+            data = self._source.read(self._read_size)
+            if data:
+                self._pending += self._compressor.compress(data)
+            else:
+                self._pending += self._compressor.flush()
+                self._exhausted = True
+
+        return take(self._pending, size)
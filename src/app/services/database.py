@@ -1,16 +1,42 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 import os
 
+from services.metrics import instrument_engine
+
 
 DATABASE_URL = os.getenv(
     "DATABASE_URL",
     "postgresql+psycopg2://postgres:password@db:5432/db",
 )
+ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL",
+    make_url(DATABASE_URL)
+    .set(drivername="postgresql+asyncpg")
+    .render_as_string(hide_password=False),
+)
 
-engine = create_engine(DATABASE_URL, echo=False, future=True)
+# Pool settings shared by the sync and the async engine
+pool_options = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": True,
+}
+
+engine = create_engine(DATABASE_URL, echo=False, future=True, **pool_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(ASYNC_DATABASE_URL, echo=False, **pool_options)
+
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -18,106 +44,6 @@ def get_db():
     finally:
         db.close()
 
-async def initialize():
-    db = SessionLocal()
-    try:
-        db.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS ingestions (
-                    id SERIAL PRIMARY KEY,
-                    payload JSONB NOT NULL,
-                    md5_hash TEXT NOT NULL UNIQUE,
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-                    status TEXT NOT NULL DEFAULT 'new',
-                    csv_filename TEXT,
-                    s3_path TEXT
-                )
-                """
-            )
-        )
-
-        db.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS patients (
-                    id SERIAL PRIMARY KEY,
-                    mrn VARCHAR(200) NOT NULL UNIQUE,
-                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
-                )
-                """
-            )
-        )
-
-        db.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS persons (
-                    id INT NOT NULL PRIMARY KEY,
-                    first_name TEXT,
-                    last_name TEXT,
-                    birth_date DATE
-                )
-                """
-            )
-        )
-
-        db.execute(
-            text(
-                """
-                CREATE TABLE IF NOT EXISTS visits (
-                    id SERIAL PRIMARY KEY,
-                    visit_account_number VARCHAR(300) UNIQUE,
-                    patient_id INT NOT NULL,
-                    visit_date DATE NOT NULL,
-                    reason TEXT
-                )
-                """
-            )
-        )
-
-        db.execute(
-            text(
-                """
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 FROM pg_constraint WHERE conname = 'person_entry'
-                    ) THEN
-                        ALTER TABLE public.patients
-                            ADD CONSTRAINT person_entry FOREIGN KEY (id)
-                                REFERENCES public.persons (id) MATCH SIMPLE
-                                ON UPDATE CASCADE
-                                ON DELETE CASCADE
-                                NOT VALID;
-                    END IF;
-                END
-                $$;
-                """
-            )
-        )
-
-        db.execute(
-            text(
-                """
-                DO $$
-                BEGIN
-                    IF NOT EXISTS (
-                        SELECT 1 FROM pg_constraint WHERE conname = 'patient_entry'
-                    ) THEN
-                        ALTER TABLE public.visits
-                            ADD CONSTRAINT patient_entry FOREIGN KEY (patient_id)
-                                REFERENCES public.patients (id) MATCH SIMPLE
-                                ON UPDATE CASCADE
-                                ON DELETE CASCADE
-                                NOT VALID;
-                    END IF;
-                END
-                $$;
-                """
-            )
-        )
-
-        db.commit()
-    finally:
-        db.close()
\ No newline at end of file
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
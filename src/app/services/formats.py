@@ -0,0 +1,168 @@
+import io
+import tempfile
+from contextlib import contextmanager
+from os import getenv
+from pathlib import PurePosixPath
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from services.csvio import CSV_HEADERS, CsvRowStream, GzipReadStream
+from services.metrics import S3_BYTES
+from services.s3 import (
+    S3_MULTIPART_CHUNKSIZE,
+    get_s3_client,
+    split_s3_path,
+    transfer_config,
+    upload_stream,
+)
+
+# Format of the intermediate object the conversion writes to S3. Objects are
+# read back according to their own key, so switching formats leaves existing
+# objects ingestible. pyarrow is only needed for parquet.
+CSV_GZIP = getenv("CSV_GZIP", "false").lower() in ("1", "true", "yes")
+INTERMEDIATE_FORMAT = getenv("INTERMEDIATE_FORMAT", "csv.gz" if CSV_GZIP else "csv")
+PARQUET_ROW_GROUP_SIZE = int(getenv("PARQUET_ROW_GROUP_SIZE", "5000"))
+PARQUET_COMPRESSION = getenv("PARQUET_COMPRESSION", "zstd")
+
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "csv.gz": "application/gzip",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+DATE_COLUMNS = ("birth_date", "visit_date")
+
+
+def detect_format(s3path: str) -> str:
+    _, key = split_s3_path(s3path)
+    suffixes = PurePosixPath(key).suffixes
+    if suffixes[-1:] == [".parquet"]:
+        return "parquet"
+    if suffixes[-1:] == [".gz"]:
+        return "csv.gz"
+    if suffixes[-1:] == [".csv"]:
+        return "csv"
+
+    # No telling suffix; fall back to the content type it was uploaded with
+    bucket, _ = split_s3_path(s3path)
+    content_type = get_s3_client().head_object(Bucket=bucket, Key=key).get("ContentType")
+    for fmt, known in CONTENT_TYPES.items():
+        if content_type == known:
+            return fmt
+    return "csv"
+
+
+def _parquet_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            (column, pa.date32() if column in DATE_COLUMNS else pa.string())
+            for column in CSV_HEADERS
+        ]
+    )
+
+
+def _arrow_batch(rows: List[Sequence], schema):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = []
+    for index, field in enumerate(schema):
+        values = pa.array([row[index] for row in rows], pa.string())
+        if field.type == pa.date32():
+            # Empty dates become nulls, as they would in the database
+            values = pc.cast(
+                pc.strptime(values, format="%Y-%m-%d", unit="s", error_is_null=True),
+                pa.date32(),
+            )
+        columns.append(values)
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def write_parquet(rows: Iterable[Sequence], fileobj, row_group_size: int = PARQUET_ROW_GROUP_SIZE) -> None:
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema()
+    with pq.ParquetWriter(fileobj, schema, compression=PARQUET_COMPRESSION) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= row_group_size:
+                writer.write_batch(_arrow_batch(batch, schema), row_group_size=row_group_size)
+                batch = []
+        if batch:
+            writer.write_batch(_arrow_batch(batch, schema), row_group_size=row_group_size)
+
+
+# Uploads rows (sequences in CSV_HEADERS order) as `{name}.<ext>` in the given
+# format; returns the filename and the S3 path
+def upload_rows(rows: Iterable[Sequence], name: str, fmt: str = INTERMEDIATE_FORMAT) -> Tuple[str, str]:
+    filename = f"{name}.{fmt}"
+    if fmt == "parquet":
+        # Parquet writes its footer last, so the file is spooled locally
+        with tempfile.TemporaryFile() as spool:
+            write_parquet(rows, spool)
+            spool.seek(0)
+            return filename, upload_stream(spool, filename, CONTENT_TYPES[fmt])
+
+    stream = CsvRowStream(rows, header=CSV_HEADERS)
+    if fmt == "csv.gz":
+        return filename, upload_stream(GzipReadStream(stream), filename, CONTENT_TYPES[fmt])
+    return filename, upload_stream(stream, filename)
+
+
+# progress is called with the bytes downloaded so far, every progress_every
+# bytes; boto3 calls it from its transfer threads
+@contextmanager
+def open_parquet(
+    s3path: str,
+    progress: Optional[Callable[[int], None]] = None,
+    progress_every: int = S3_MULTIPART_CHUNKSIZE,
+) -> Iterator:
+    import pyarrow.parquet as pq
+
+    downloaded = S3_BYTES.labels("download")
+    total = [0, 0]
+
+    def callback(size: int) -> None:
+        downloaded.inc(size)
+        total[0] += size
+        if progress is not None and total[0] - total[1] >= progress_every:
+            total[1] = total[0]
+            progress(total[0])
+
+    # Parquet needs random access (footer first), so the object is fetched
+    # into a local temp file with the shared multipart transfer settings
+    bucket, key = split_s3_path(s3path)
+    with tempfile.TemporaryFile() as local:
+        get_s3_client().download_fileobj(
+            bucket, key, local, Config=transfer_config, Callback=callback
+        )
+        local.seek(0)
+        yield pq.ParquetFile(local)
+
+
+def copy_csv(table, first_row_num: int = 1) -> io.BytesIO:
+    # CSV for COPY into the staging table: row_num first, then the columns in
+    # CSV_HEADERS order. Nulls are written as unquoted empty fields and empty
+    # strings as "", which COPY's default CSV NULL handling keeps apart.
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    row_nums = pa.array(range(first_row_num, first_row_num + table.num_rows), pa.int64())
+    staged = pa.table(
+        [row_nums] + [table.column(column) for column in CSV_HEADERS],
+        names=["row_num"] + CSV_HEADERS,
+    )
+    buffer = io.BytesIO()
+    pa_csv.write_csv(staged, buffer, pa_csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    return buffer
+
+
+def string_rows(table) -> List[dict]:
+    import pyarrow as pa
+
+    return table.select(CSV_HEADERS).cast(
+        pa.schema([(column, pa.string()) for column in CSV_HEADERS])
+    ).to_pylist()
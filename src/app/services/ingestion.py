@@ -0,0 +1,581 @@
+import csv
+import io
+import zlib
+from datetime import date
+from itertools import chain, islice
+from os import getenv
+from typing import IO, BinaryIO, Callable, Iterable, Iterator, List, Mapping, Optional, Set
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from services.cache import PATIENT_CHANGES_CHANNEL
+from services.csvio import CSV_HEADERS, CsvRowStream
+from services.formats import copy_csv, string_rows
+from services.metrics import INGESTED_ROWS
+from services.partitions import ensure_visit_partitions
+
+INGEST_MODE = getenv("INGEST_MODE", "bulk")
+INGEST_CHUNK_SIZE = int(getenv("INGEST_CHUNK_SIZE", "5000"))
+# Skip rows identical to the last ingested row for their visit_account_number
+INGEST_ROW_DEDUP = getenv("INGEST_ROW_DEDUP", "true").lower() in ("1", "true", "yes")
+
+# Marker used for missing values in the COPY stream; empty strings stay empty
+# strings so the staged data matches what the per-row path would have bound.
+COPY_NULL = "\\N"
+
+# Keeps every NOTIFY payload well under Postgres' 8000 byte limit
+NOTIFY_BATCH_SIZE = 500
+
+
+def notify_patient_changes(db: Session, patient_ids: Iterable[int]) -> None:
+    # Delivered to listeners (the API's patient cache) only once the
+    # surrounding transaction commits
+    ids = sorted(set(patient_ids))
+    for start in range(0, len(ids), NOTIFY_BATCH_SIZE):
+        db.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {
+                "channel": PATIENT_CHANGES_CHANNEL,
+                "payload": ",".join(str(i) for i in ids[start:start + NOTIFY_BATCH_SIZE]),
+            },
+        )
+
+
+def refresh_name_tokens(db: Session, patient_ids: Iterable[int]) -> None:
+    # Rebuilds the /patients/search tokens of the given persons
+    db.execute(
+        text("SELECT refresh_person_name_tokens(:ids)"),
+        {"ids": sorted(set(patient_ids))},
+    )
+
+
+def _record_row_hash(db: Session, row: Mapping[str, str]) -> None:
+    db.execute(
+        text(
+            f"""
+            INSERT INTO visit_row_hashes (visit_account_number, row_hash)
+            VALUES (:visit_account_number, ingest_row_hash({", ".join(":" + c for c in CSV_HEADERS)}))
+            ON CONFLICT (visit_account_number) DO UPDATE SET
+                row_hash = EXCLUDED.row_hash,
+                updated_at = NOW()
+            WHERE visit_row_hashes.row_hash <> EXCLUDED.row_hash
+            """
+        ),
+        {column: row.get(column) for column in CSV_HEADERS},
+    )
+
+
+def _unchanged_accounts(db: Session, last_rows: List[Mapping[str, str]]) -> Set[str]:
+    # Account numbers whose given (last) row matches the stored hash
+    return set(
+        db.execute(
+            text(
+                f"""
+                SELECT l.visit_account_number
+                FROM unnest({", ".join(f"CAST(:{c} AS TEXT[])" for c in CSV_HEADERS)})
+                    AS l({", ".join(CSV_HEADERS)})
+                JOIN visit_row_hashes h
+                    ON h.visit_account_number = l.visit_account_number
+                   AND h.row_hash = ingest_row_hash({", ".join("l." + c for c in CSV_HEADERS)})
+                """
+            ),
+            {column: [row.get(column) for row in last_rows] for column in CSV_HEADERS},
+        ).scalars()
+    )
+
+
+def _visit_months(values: Iterable[Optional[str]]) -> List[date]:
+    months = set()
+    for value in values:
+        try:
+            months.add(date.fromisoformat(value).replace(day=1))
+        except (TypeError, ValueError):
+            # Left for the visits insert to reject
+            pass
+    return list(months)
+
+
+def ingest_rows(db: Session, rows: Iterable[Mapping[str, str]]) -> int:
+    # The chunk is read up front so the visit partitions it needs exist
+    # before this transaction writes anything
+    rows = list(rows)
+    ensure_visit_partitions(_visit_months(row.get("visit_date") for row in rows))
+
+    # Same rule as the bulk path: an account number whose last row here
+    # matches the stored hash is skipped altogether
+    last_rows = {}
+    unchanged = set()
+    if INGEST_ROW_DEDUP:
+        for row in rows:
+            if row.get("visit_account_number") is not None:
+                last_rows[row["visit_account_number"]] = row
+        unchanged = _unchanged_accounts(db, list(last_rows.values()))
+
+    count = 0
+    patient_ids = set()
+    for row in rows:
+        count += 1
+        if row.get("visit_account_number") in unchanged:
+            continue
+
+        # Check if patient already exists
+        existing = db.execute(
+            text("SELECT id FROM patients WHERE mrn = :mrn"),
+            {"mrn": row["mrn"]},
+        ).scalar()
+
+        if existing is not None:
+            patient_id = existing
+            db.execute(
+                text(
+                    """
+                    INSERT INTO persons (id, first_name, last_name, birth_date)
+                    VALUES (:id, :first_name, :last_name, :birth_date)
+                    ON CONFLICT (id) DO UPDATE SET
+                        first_name = COALESCE(EXCLUDED.first_name, persons.first_name),
+                        last_name = COALESCE(EXCLUDED.last_name, persons.last_name),
+                        birth_date = COALESCE(EXCLUDED.birth_date, persons.birth_date)
+                    """
+                ),
+                {
+                    "id": patient_id,
+                    "first_name": row["first_name"] or None,
+                    "last_name": row["last_name"] or None,
+                    "birth_date": row["birth_date"] or None,
+                },
+            )
+        else:
+            # New patient: get next id from sequence
+            patient_id = db.execute(
+                text("SELECT nextval('patients_id_seq')")
+            ).scalar()
+            # Insert person first (FK: patients.id → persons.id)
+            db.execute(
+                text(
+                    """
+                    INSERT INTO persons (id, first_name, last_name, birth_date)
+                    VALUES (:id, :first_name, :last_name, :birth_date)
+                    """
+                ),
+                {
+                    "id": patient_id,
+                    "first_name": row["first_name"] or None,
+                    "last_name": row["last_name"] or None,
+                    "birth_date": row["birth_date"] or None,
+                },
+            )
+            # Insert patient with the same id
+            db.execute(
+                text(
+                    "INSERT INTO patients (id, mrn) VALUES (:id, :mrn)"
+                ),
+                {"id": patient_id, "mrn": row["mrn"]},
+            )
+
+        # Insert visit (skip duplicates): the account number registry is what
+        # keeps visit_account_number unique across the partitions
+        db.execute(
+            text(
+                """
+                WITH registered AS (
+                    INSERT INTO visit_account_numbers (visit_account_number, visit_date)
+                    SELECT :visit_account_number, CAST(:visit_date AS DATE)
+                    WHERE CAST(:visit_account_number AS VARCHAR) IS NOT NULL
+                    ON CONFLICT (visit_account_number) DO NOTHING
+                    RETURNING visit_account_number
+                )
+                INSERT INTO visits (visit_account_number, patient_id, visit_date, reason)
+                SELECT :visit_account_number, :patient_id, CAST(:visit_date AS DATE), :reason
+                WHERE CAST(:visit_account_number AS VARCHAR) IS NULL
+                   OR EXISTS (SELECT 1 FROM registered)
+                """
+            ),
+            {
+                "visit_account_number": row["visit_account_number"],
+                "patient_id": patient_id,
+                "visit_date": row["visit_date"],
+                "reason": row["reason"],
+            },
+        )
+        patient_ids.add(patient_id)
+
+    for account, row in last_rows.items():
+        if account not in unchanged:
+            _record_row_hash(db, row)
+
+    refresh_name_tokens(db, patient_ids)
+    notify_patient_changes(db, patient_ids)
+    return count
+
+
+def _copy_records(rows: Iterable[Mapping[str, str]]):
+    for row_num, row in enumerate(rows, start=1):
+        yield [row_num] + [
+            COPY_NULL if row.get(column) is None else row[column]
+            for column in CSV_HEADERS
+        ]
+
+
+def _copy_into_staging(db: Session, stream: BinaryIO, null: str) -> int:
+    db.execute(
+        text(
+            """
+            CREATE TEMP TABLE ingest_staging (
+                row_num BIGINT NOT NULL,
+                mrn TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                birth_date TEXT,
+                visit_account_number TEXT,
+                visit_date TEXT,
+                reason TEXT
+            ) ON COMMIT DROP
+            """
+        )
+    )
+
+    # Stream the rows into the staging table with a single COPY
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"""
+            COPY ingest_staging (row_num, {", ".join(CSV_HEADERS)})
+            FROM STDIN WITH (FORMAT csv, NULL '{null}')
+            """,
+            stream,
+        )
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def _apply_staging(db: Session) -> None:
+    if INGEST_ROW_DEDUP:
+        # The stored hash is that of the last row applied for an account
+        # number. When the last row for it here matches, every row for it is
+        # dropped: the earlier ones were followed by that row the last time
+        # too, so applying them again would only undo and redo its changes.
+        db.execute(
+            text(
+                f"""
+                DELETE FROM ingest_staging s
+                USING (
+                    SELECT DISTINCT ON (visit_account_number)
+                        visit_account_number,
+                        ingest_row_hash({", ".join(CSV_HEADERS)}) AS row_hash
+                    FROM ingest_staging
+                    WHERE visit_account_number IS NOT NULL
+                    ORDER BY visit_account_number, row_num DESC
+                ) last
+                JOIN visit_row_hashes h
+                    ON h.visit_account_number = last.visit_account_number
+                   AND h.row_hash = last.row_hash
+                WHERE s.visit_account_number = last.visit_account_number
+                """
+            )
+        )
+
+    db.execute(text("ANALYZE ingest_staging"))
+
+    # Before anything is written, see ensure_visit_partitions
+    ensure_visit_partitions(
+        db.execute(
+            text(
+                """
+                SELECT DISTINCT date_trunc('month', NULLIF(visit_date, '')::DATE)::DATE
+                FROM ingest_staging
+                WHERE NULLIF(visit_date, '') IS NOT NULL
+                """
+            )
+        ).scalars()
+    )
+
+    # One row per MRN carrying the last non-empty value of each person field,
+    # which is what applying the rows one by one with COALESCE ends up with
+    db.execute(
+        text(
+            """
+            CREATE TEMP TABLE ingest_patients ON COMMIT DROP AS
+            SELECT
+                s.mrn,
+                p.id AS patient_id,
+                p.id IS NULL AS is_new,
+                MIN(s.row_num) AS first_row,
+                (ARRAY_AGG(NULLIF(s.first_name, '') ORDER BY s.row_num DESC)
+                    FILTER (WHERE NULLIF(s.first_name, '') IS NOT NULL))[1] AS first_name,
+                (ARRAY_AGG(NULLIF(s.last_name, '') ORDER BY s.row_num DESC)
+                    FILTER (WHERE NULLIF(s.last_name, '') IS NOT NULL))[1] AS last_name,
+                (ARRAY_AGG(NULLIF(s.birth_date, '') ORDER BY s.row_num DESC)
+                    FILTER (WHERE NULLIF(s.birth_date, '') IS NOT NULL))[1]::DATE AS birth_date
+            FROM ingest_staging s
+            LEFT JOIN patients p ON p.mrn = s.mrn
+            GROUP BY s.mrn, p.id
+            """
+        )
+    )
+
+    # New patients get ids in order of first appearance in the file
+    db.execute(
+        text(
+            """
+            UPDATE ingest_patients t
+            SET patient_id = n.id
+            FROM (
+                SELECT o.mrn, nextval('patients_id_seq') AS id
+                FROM (
+                    SELECT mrn FROM ingest_patients
+                    WHERE is_new
+                    ORDER BY first_row
+                ) o
+            ) n
+            WHERE t.mrn = n.mrn
+            """
+        )
+    )
+
+    db.execute(
+        text(
+            """
+            INSERT INTO persons (id, first_name, last_name, birth_date)
+            SELECT patient_id, first_name, last_name, birth_date
+            FROM ingest_patients
+            ORDER BY first_row
+            ON CONFLICT (id) DO UPDATE SET
+                first_name = COALESCE(EXCLUDED.first_name, persons.first_name),
+                last_name = COALESCE(EXCLUDED.last_name, persons.last_name),
+                birth_date = COALESCE(EXCLUDED.birth_date, persons.birth_date)
+            """
+        )
+    )
+
+    db.execute(
+        text(
+            """
+            INSERT INTO patients (id, mrn)
+            SELECT patient_id, mrn
+            FROM ingest_patients
+            WHERE is_new
+            ORDER BY first_row
+            """
+        )
+    )
+
+    # The first row wins for a repeated visit_account_number, as before; only
+    # the account numbers new to the registry get a visit. Rows without one
+    # are never duplicates of each other and all get a visit.
+    db.execute(
+        text(
+            """
+            WITH v AS (
+                (
+                    SELECT DISTINCT ON (s.visit_account_number)
+                        s.row_num,
+                        s.visit_account_number,
+                        p.patient_id,
+                        s.visit_date::DATE AS visit_date,
+                        s.reason
+                    FROM ingest_staging s
+                    JOIN ingest_patients p ON p.mrn = s.mrn
+                    WHERE s.visit_account_number IS NOT NULL
+                    ORDER BY s.visit_account_number, s.row_num
+                )
+                UNION ALL
+                SELECT
+                    s.row_num,
+                    s.visit_account_number,
+                    p.patient_id,
+                    s.visit_date::DATE,
+                    s.reason
+                FROM ingest_staging s
+                JOIN ingest_patients p ON p.mrn = s.mrn
+                WHERE s.visit_account_number IS NULL
+            ),
+            registered AS (
+                INSERT INTO visit_account_numbers (visit_account_number, visit_date)
+                SELECT visit_account_number, visit_date
+                FROM v
+                WHERE visit_account_number IS NOT NULL
+                ORDER BY row_num
+                ON CONFLICT (visit_account_number) DO NOTHING
+                RETURNING visit_account_number
+            )
+            INSERT INTO visits (visit_account_number, patient_id, visit_date, reason)
+            SELECT v.visit_account_number, v.patient_id, v.visit_date, v.reason
+            FROM v
+            LEFT JOIN registered r ON r.visit_account_number = v.visit_account_number
+            WHERE v.visit_account_number IS NULL
+               OR r.visit_account_number IS NOT NULL
+            ORDER BY v.row_num
+            """
+        )
+    )
+
+    if INGEST_ROW_DEDUP:
+        db.execute(
+            text(
+                f"""
+                INSERT INTO visit_row_hashes (visit_account_number, row_hash)
+                SELECT DISTINCT ON (visit_account_number)
+                    visit_account_number,
+                    ingest_row_hash({", ".join(CSV_HEADERS)})
+                FROM ingest_staging
+                WHERE visit_account_number IS NOT NULL
+                ORDER BY visit_account_number, row_num DESC
+                ON CONFLICT (visit_account_number) DO UPDATE SET
+                    row_hash = EXCLUDED.row_hash,
+                    updated_at = NOW()
+                """
+            )
+        )
+
+    db.execute(
+        text(
+            "SELECT refresh_person_name_tokens(ARRAY(SELECT patient_id FROM ingest_patients))"
+        )
+    )
+
+    notify_patient_changes(
+        db, db.execute(text("SELECT patient_id FROM ingest_patients")).scalars()
+    )
+
+    db.execute(text("DROP TABLE ingest_patients, ingest_staging"))
+
+
+def bulk_ingest_rows(db: Session, rows: Iterable[Mapping[str, str]]) -> int:
+    count = _copy_into_staging(db, CsvRowStream(_copy_records(rows)), COPY_NULL)
+    _apply_staging(db)
+    return count
+
+
+def bulk_ingest_copy_csv(db: Session, stream: BinaryIO) -> int:
+    # `stream` already is COPY input: row_num followed by the CSV_HEADERS
+    # columns, no header, nulls as unquoted empty fields
+    count = _copy_into_staging(db, stream, "")
+    _apply_staging(db)
+    return count
+
+
+def ingest(db: Session, rows: Iterable[Mapping[str, str]]) -> int:
+    if INGEST_MODE == "row":
+        return ingest_rows(db, rows)
+    return bulk_ingest_rows(db, rows)
+
+
+def ingest_parquet_chunks(db: Session, parquet, checkpoint: Optional[dict] = None) -> Iterator[dict]:
+    # One commit per row group; the checkpoint is the next row group to read
+    checkpoint = dict(checkpoint or {"row_group": 0, "rows": 0})
+    for index in range(checkpoint["row_group"], parquet.num_row_groups):
+        table = parquet.read_row_group(index)
+        if INGEST_MODE == "row":
+            count = ingest_rows(db, string_rows(table))
+        else:
+            count = bulk_ingest_copy_csv(db, copy_csv(table))
+        db.commit()
+        INGESTED_ROWS.labels("parquet").inc(count)
+
+        checkpoint = {"row_group": index + 1, "rows": checkpoint["rows"] + count}
+        yield checkpoint
+
+
+# Parses CSV records from a binary stream while keeping track of the byte
+# offset right after the last record handed out, so ingestion can resume
+# from that point without re-reading what was already committed.
+class CsvRecordReader:
+    def __init__(
+        self,
+        stream: BinaryIO,
+        offset: int = 0,
+        fieldnames: Optional[List[str]] = None,
+    ) -> None:
+        self.offset = offset
+        self.fieldnames = fieldnames
+        self._reader = csv.reader(self._lines(stream))
+
+    def _lines(self, stream: BinaryIO) -> Iterator[str]:
+        for line in stream:
+            self.offset += len(line)
+            yield line.decode("utf-8")
+
+    def __iter__(self) -> Iterator[dict]:
+        if self.fieldnames is None:
+            self.fieldnames = next(self._reader, None)
+            if self.fieldnames is None:
+                return
+
+        for values in self._reader:
+            if not values:
+                continue
+            row = dict(zip(self.fieldnames, values))
+            for key in self.fieldnames[len(values):]:
+                row[key] = None
+            yield row
+
+
+def ingest_csv_chunks(
+    db: Session,
+    stream: BinaryIO,
+    checkpoint: Optional[dict] = None,
+    chunk_size: int = INGEST_CHUNK_SIZE,
+) -> Iterator[dict]:
+    # `stream` must already be positioned at checkpoint["offset"]
+    checkpoint = dict(checkpoint or {"offset": 0, "rows": 0, "fieldnames": None})
+    reader = CsvRecordReader(stream, checkpoint["offset"], checkpoint["fieldnames"])
+    records = iter(reader)
+
+    while True:
+        first = next(records, None)
+        if first is None:
+            return
+
+        rest = islice(records, chunk_size - 1) if chunk_size > 0 else records
+        count = ingest(db, chain([first], rest))
+        db.commit()
+        INGESTED_ROWS.labels("csv").inc(count)
+
+        checkpoint = {
+            "offset": reader.offset,
+            "rows": checkpoint["rows"] + count,
+            "fieldnames": reader.fieldnames,
+        }
+        yield checkpoint
+
+
+def mrn_shard(mrn: str, shards: int) -> int:
+    # Stable across processes, unlike hash()
+    return zlib.crc32(mrn.encode("utf-8")) % shards
+
+
+# Distributes the records of a CSV stream over `outputs` (text files opened
+# with newline=""), each getting the header and every record whose MRN hashes
+# to it. Returns the number of records written to each output.
+def split_csv_by_mrn(
+    stream: BinaryIO,
+    outputs: List[IO[str]],
+    progress: Optional[Callable[[int], None]] = None,
+    progress_every: int = 100_000,
+) -> List[int]:
+    reader = csv.reader(io.TextIOWrapper(stream, encoding="utf-8", newline=""))
+    header = next(reader, None)
+    counts = [0] * len(outputs)
+    if header is None:
+        return counts
+
+    mrn_index = header.index("mrn")
+    writers = [csv.writer(output) for output in outputs]
+    for writer in writers:
+        writer.writerow(header)
+
+    total = 0
+    for values in reader:
+        if not values:
+            continue
+        mrn = values[mrn_index] if mrn_index < len(values) else ""
+        shard = mrn_shard(mrn, len(outputs))
+        writers[shard].writerow(values)
+        counts[shard] += 1
+        total += 1
+        if progress is not None and total % progress_every == 0:
+            progress(total)
+
+    return counts
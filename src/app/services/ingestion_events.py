@@ -0,0 +1,55 @@
+import asyncio
+import json
+from os import getenv
+from typing import List, Optional
+
+# Channel the ingestions trigger publishes status changes on
+INGESTION_STATUS_CHANNEL = "ingestion_status"
+# Statuses an ingestion ends in: its rows are in the database, or its
+# conversion kept failing
+FINAL_STATUSES = ("ingested", "failed")
+STATUS_EVENTS_QUEUE_SIZE = int(getenv("STATUS_EVENTS_QUEUE_SIZE", "1000"))
+
+
+class StatusSubscription:
+    def __init__(self, maxsize: int = STATUS_EVENTS_QUEUE_SIZE) -> None:
+        self.queue: "asyncio.Queue[Optional[dict]]" = asyncio.Queue(maxsize)
+        # Set when events may have been missed; the subscriber then reloads
+        # the statuses it follows from the database
+        self.stale = False
+
+    def _push(self, event: Optional[dict]) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.stale = True
+
+
+# Fans the status notifications received by the API's listener out to the
+# open event streams of this process
+class StatusBroker:
+    def __init__(self) -> None:
+        self._subscriptions: List[StatusSubscription] = []
+
+    def subscribe(self) -> StatusSubscription:
+        subscription = StatusSubscription()
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: StatusSubscription) -> None:
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def publish(self, payload: str) -> None:
+        event = json.loads(payload)
+        for subscription in self._subscriptions:
+            subscription._push(event)
+
+    def resync(self) -> None:
+        # Notifications sent while the listener was down are lost
+        for subscription in self._subscriptions:
+            subscription.stale = True
+            subscription._push(None)
+
+
+status_broker = StatusBroker()
@@ -0,0 +1,114 @@
+import time
+from os import getenv
+
+from prometheus_client import Counter, Histogram, start_http_server
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from temporalio import activity
+from temporalio.worker import (
+    ActivityInboundInterceptor,
+    ExecuteActivityInput,
+    Interceptor,
+)
+
+WORKER_METRICS_PORT = int(getenv("WORKER_METRICS_PORT", "9100"))
+
+# Buckets reaching into the minutes, for activities and big S3 transfers
+LONG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "API request latency",
+    ["method", "route", "status"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Database statement latency",
+    ["statement"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+ACTIVITY_SECONDS = Histogram(
+    "temporal_activity_duration_seconds",
+    "Temporal activity execution time",
+    ["activity", "outcome"],
+    buckets=LONG_BUCKETS,
+)
+S3_REQUEST_SECONDS = Histogram(
+    "s3_request_duration_seconds",
+    "S3 API call latency",
+    ["operation"],
+    buckets=LONG_BUCKETS,
+)
+S3_BYTES = Counter(
+    "s3_transferred_bytes",
+    "Bytes moved to and from S3",
+    ["direction"],
+)
+INGESTED_ROWS = Counter(
+    "ingested_rows",
+    "CSV/Parquet rows committed by the ingestion",
+    ["format"],
+)
+
+
+def _statement_kind(statement: str) -> str:
+    # First keyword only, so the label set stays small
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "OTHER"
+
+
+def instrument_engine(engine: Engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        DB_QUERY_SECONDS.labels(_statement_kind(statement)).observe(
+            time.perf_counter() - started
+        )
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        # The statement failed, so after_cursor_execute will not run for it
+        started = context.connection.info.get("query_started") if context.connection else None
+        if started:
+            started.pop()
+
+
+def instrument_s3_client(s3_client) -> None:
+    events = s3_client.meta.events
+
+    def _before(context, **kwargs):
+        context["metrics_started"] = time.perf_counter()
+
+    def _after(context, model, **kwargs):
+        started = context.get("metrics_started")
+        if started is not None:
+            S3_REQUEST_SECONDS.labels(model.name).observe(time.perf_counter() - started)
+
+    events.register("before-call.s3", _before)
+    events.register("after-call.s3", _after)
+
+
+class _ActivityMetrics(ActivityInboundInterceptor):
+    async def execute_activity(self, input: ExecuteActivityInput):
+        name = activity.info().activity_type
+        started = time.perf_counter()
+        outcome = "failed"
+        try:
+            result = await super().execute_activity(input)
+            outcome = "completed"
+            return result
+        finally:
+            ACTIVITY_SECONDS.labels(name, outcome).observe(time.perf_counter() - started)
+
+
+class ActivityMetricsInterceptor(Interceptor):
+    def intercept_activity(self, next: ActivityInboundInterceptor) -> ActivityInboundInterceptor:
+        return _ActivityMetrics(next)
+
+
+def start_worker_metrics_server(port: int = WORKER_METRICS_PORT) -> None:
+    start_http_server(port)
@@ -0,0 +1,154 @@
+import re
+import sys
+import time
+from os import getenv
+from pathlib import Path
+from typing import List, NamedTuple, Set
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from services.database import engine
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / "migrations"
+MIGRATE_ON_STARTUP = getenv("MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+# Arbitrary key for the advisory lock that serializes migration runs across
+# API replicas starting at the same time
+MIGRATION_LOCK_ID = 720_431_001
+MIGRATION_LOCK_POLL_SECONDS = 1.0
+
+# First line marker for migrations that must run outside a transaction
+# (e.g. CREATE INDEX CONCURRENTLY); their statements run one by one
+NO_TRANSACTION_MARKER = "-- migrate: no-transaction"
+
+CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)",
+    re.IGNORECASE,
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str
+
+    @property
+    def transactional(self) -> bool:
+        return not self.sql.startswith(NO_TRANSACTION_MARKER)
+
+    def statements(self) -> List[str]:
+        statements = []
+        for chunk in re.split(r";\s*$", self.sql, flags=re.MULTILINE):
+            lines = [line for line in chunk.strip().splitlines() if not line.startswith("--")]
+            if lines:
+                statements.append("\n".join(lines))
+        return statements
+
+
+def load_migrations(directory: Path = MIGRATIONS_DIR) -> List[Migration]:
+    migrations = []
+    for path in sorted(directory.glob("*.sql")):
+        version, _, name = path.stem.partition("_")
+        migrations.append(Migration(int(version), name, path.read_text(encoding="utf-8")))
+    return migrations
+
+
+def _applied_versions(conn: Connection) -> Set[int]:
+    if conn.execute(text("SELECT to_regclass('schema_migrations')")).scalar() is None:
+        return set()
+    return set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def _apply(conn: Connection, migration: Migration) -> None:
+    record = text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)")
+    params = {"version": migration.version, "name": migration.name}
+
+    if migration.transactional:
+        with engine.begin() as tx:
+            tx.exec_driver_sql(migration.sql)
+            tx.execute(record, params)
+        return
+
+    # `conn` is in autocommit mode; if one of the statements fails the
+    # migration stays unrecorded and is retried as a whole on the next run.
+    # The statements must be safe to re-run (IF NOT EXISTS). That alone is not
+    # enough for CREATE INDEX CONCURRENTLY, see _drop_invalid_index.
+    for statement in migration.statements():
+        _drop_invalid_index(conn, statement)
+        conn.exec_driver_sql(statement)
+    conn.execute(record, params)
+
+
+# A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which
+# IF NOT EXISTS would then skip on the retry; it is dropped so the retry
+# builds it again
+def _drop_invalid_index(conn: Connection, statement: str) -> None:
+    match = CONCURRENT_INDEX.search(statement)
+    if match is None:
+        return
+    invalid = conn.execute(
+        text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": match.group(1)},
+    ).scalar()
+    if invalid:
+        conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+
+
+def _lock(conn: Connection) -> None:
+    # Poll instead of blocking in pg_advisory_lock: a session waiting inside
+    # that call counts as an open transaction, and CREATE INDEX CONCURRENTLY
+    # run by the lock holder would wait for it forever
+    while not conn.execute(
+        text("SELECT pg_try_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID}
+    ).scalar():
+        time.sleep(MIGRATION_LOCK_POLL_SECONDS)
+
+
+def pending_migrations() -> List[Migration]:
+    with engine.connect() as conn:
+        applied = _applied_versions(conn)
+    return [m for m in load_migrations() if m.version not in applied]
+
+
+def migrate() -> List[Migration]:
+    # Cheap check first, so booting an up-to-date replica is one or two
+    # SELECTs instead of a block of DDL
+    if not pending_migrations():
+        return []
+
+    applied = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        _lock(conn)
+        try:
+            conn.exec_driver_sql(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+                """
+            )
+            # Another replica may have applied some while we waited for the lock
+            done = _applied_versions(conn)
+            for migration in load_migrations():
+                if migration.version in done:
+                    continue
+                _apply(conn, migration)
+                applied.append(migration)
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+
+    return applied
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        pending = pending_migrations()
+        for migration in pending:
+            print(f"pending {migration.version:04d}_{migration.name}")
+        sys.exit(1 if pending else 0)
+
+    for migration in migrate():
+        print(f"applied {migration.version:04d}_{migration.name}")
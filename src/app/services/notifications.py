@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+import asyncpg
+from sqlalchemy import make_url
+
+from services.database import ASYNC_DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+# asyncpg takes a plain libpq style URL
+LISTEN_DSN = (
+    make_url(ASYNC_DATABASE_URL)
+    .set(drivername="postgresql")
+    .render_as_string(hide_password=False)
+)
+RECONNECT_DELAY_SECONDS = 5.0
+
+Handler = Callable[[str], None]
+
+
+# Keeps one dedicated connection LISTENing on every subscribed channel and
+# hands payloads to the registered handlers. Notifications sent while the
+# connection is down are lost, so `on_reconnect` handlers get a chance to
+# resynchronize (e.g. drop a cache) after every reconnect.
+class NotificationListener:
+    def __init__(self, dsn: str = LISTEN_DSN) -> None:
+        self._dsn = dsn
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._reconnect_handlers: List[Callable[[], None]] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self, channel: str, handler: Handler) -> None:
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def on_reconnect(self, handler: Callable[[], None]) -> None:
+        self._reconnect_handlers.append(handler)
+
+    def _dispatch(self, connection, pid: int, channel: str, payload: str) -> None:
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception("Notification handler for %s failed", channel)
+
+    async def _listen_once(self, first: bool) -> None:
+        connection = await asyncpg.connect(self._dsn)
+        closed = asyncio.Event()
+        connection.add_termination_listener(lambda _: closed.set())
+        try:
+            for channel in self._handlers:
+                await connection.add_listener(channel, self._dispatch)
+            if not first:
+                for handler in self._reconnect_handlers:
+                    handler()
+            await closed.wait()
+        finally:
+            await connection.close()
+
+    async def _run(self) -> None:
+        first = True
+        while True:
+            try:
+                await self._listen_once(first)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Notification listener connection failed")
+            first = False
+            await asyncio.sleep(RECONNECT_DELAY_SECONDS)
+
+    def start(self) -> None:
+        if self._task is None and self._handlers:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+listener = NotificationListener()
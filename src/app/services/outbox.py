@@ -0,0 +1,140 @@
+import asyncio
+import logging
+from os import getenv
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from services.database import AsyncSessionLocal
+from services.temporal import start_csv_conversion
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_CHANNEL = "workflow_outbox"
+OUTBOX_BATCH_SIZE = int(getenv("OUTBOX_BATCH_SIZE", "100"))
+# Fallback poll, for retries coming due and missed notifications
+OUTBOX_POLL_SECONDS = float(getenv("OUTBOX_POLL_SECONDS", "5"))
+OUTBOX_RETRY_BASE_SECONDS = float(getenv("OUTBOX_RETRY_BASE_SECONDS", "1"))
+OUTBOX_RETRY_MAX_SECONDS = float(getenv("OUTBOX_RETRY_MAX_SECONDS", "300"))
+
+
+# Queues the conversion of an ingestion. Part of the caller's transaction:
+# the start is only dispatched once that commits, and NOTIFY is only
+# delivered then as well.
+async def enqueue_conversion(db: AsyncSession, entry_id: int) -> None:
+    await db.execute(
+        text("INSERT INTO workflow_outbox (ingestion_id) VALUES (:id)"),
+        {"id": entry_id},
+    )
+    await db.execute(text("SELECT pg_notify(:channel, '')"), {"channel": OUTBOX_CHANNEL})
+
+
+async def _start(entry_id: int) -> Optional[BaseException]:
+    try:
+        await start_csv_conversion(entry_id)
+    except Exception as e:
+        return e
+    return None
+
+
+# Starts the workflows queued in workflow_outbox. Rows are claimed with
+# SKIP LOCKED, so every API process can run a dispatcher.
+class OutboxDispatcher:
+    def __init__(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def wake(self, payload: str = "") -> None:
+        self._wakeup.set()
+
+    async def dispatch_once(self) -> int:
+        async with AsyncSessionLocal() as db:
+            rows = (
+                await db.execute(
+                    text(
+                        """
+                        SELECT id, ingestion_id
+                        FROM workflow_outbox
+                        WHERE available_at <= NOW()
+                        ORDER BY available_at, id
+                        LIMIT :limit
+                        FOR UPDATE SKIP LOCKED
+                        """
+                    ),
+                    {"limit": OUTBOX_BATCH_SIZE},
+                )
+            ).all()
+            if not rows:
+                return 0
+
+            errors = await asyncio.gather(*(_start(row.ingestion_id) for row in rows))
+
+            started = [row.id for row, error in zip(rows, errors) if error is None]
+            failed = [
+                {"id": row.id, "error": repr(error)}
+                for row, error in zip(rows, errors)
+                if error is not None
+            ]
+            if started:
+                await db.execute(
+                    text("DELETE FROM workflow_outbox WHERE id = ANY(:ids)"),
+                    {"ids": started},
+                )
+            if failed:
+                logger.warning("%d of %d workflow starts failed, retrying later", len(failed), len(rows))
+                await db.execute(
+                    text(
+                        """
+                        UPDATE workflow_outbox
+                        SET attempts = attempts + 1,
+                            available_at = NOW() + make_interval(
+                                secs => LEAST(:max_delay, :base_delay * power(2, attempts))
+                            ),
+                            last_error = :error
+                        WHERE id = :id
+                        """
+                    ),
+                    [
+                        {
+                            **row,
+                            "base_delay": OUTBOX_RETRY_BASE_SECONDS,
+                            "max_delay": OUTBOX_RETRY_MAX_SECONDS,
+                        }
+                        for row in failed
+                    ],
+                )
+            await db.commit()
+            return len(rows)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                # A full batch means more may be waiting
+                while await self.dispatch_once() >= OUTBOX_BATCH_SIZE:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Workflow outbox dispatch failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+dispatcher = OutboxDispatcher()
@@ -0,0 +1,35 @@
+import base64
+import binascii
+import json
+from typing import Any, Callable, Dict, Mapping
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values: Mapping[str, Any]) -> str:
+    raw = json.dumps(values, separators=(",", ":"), default=str).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, fields: Mapping[str, Callable[[Any], Any]]) -> Dict[str, Any]:
+    # `fields` maps every key the cursor must carry to the function that
+    # turns the JSON value back into the type used in the query
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw)
+        return {name: convert(values[name]) for name, convert in fields.items()}
+    except (binascii.Error, KeyError, TypeError, ValueError) as e:
+        raise InvalidCursor("Invalid cursor") from e
+
+
+def estimate_count(db: Session, query: str, params: Mapping[str, Any]) -> int:
+    # Row estimate from the planner statistics instead of running COUNT(*)
+    plan = db.execute(text(f"EXPLAIN (FORMAT JSON) {query}"), params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
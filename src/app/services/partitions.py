@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from datetime import date
+from os import getenv
+from typing import Iterable, Optional, Set
+
+from sqlalchemy import text
+
+from services.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Months created ahead of time by the API, on startup and then periodically
+VISIT_PARTITIONS_AHEAD_MONTHS = int(getenv("VISIT_PARTITIONS_AHEAD_MONTHS", "3"))
+VISIT_PARTITIONS_CHECK_SECONDS = float(getenv("VISIT_PARTITIONS_CHECK_SECONDS", "3600"))
+# Creating a partition locks the whole visits table; give up (and let the
+# activity retry) rather than queue every reader behind a long wait
+VISIT_PARTITION_LOCK_TIMEOUT = getenv("VISIT_PARTITION_LOCK_TIMEOUT", "10s")
+
+# Months known to have a partition; partitions are never dropped by the app
+_known_months: Set[date] = set()
+
+
+# Runs in its own short transaction on a separate connection, so the lock
+# is released right away instead of being held until the caller's
+# ingestion chunk commits. Callers must not have written to visits yet in
+# their own transaction, or this would wait for them.
+def ensure_visit_partitions(dates: Iterable[date]) -> None:
+    months = {d.replace(day=1) for d in dates if d is not None} - _known_months
+    if not months:
+        return
+
+    with engine.begin() as conn:
+        conn.execute(
+            text("SELECT set_config('lock_timeout', :timeout, true)"),
+            {"timeout": VISIT_PARTITION_LOCK_TIMEOUT},
+        )
+        conn.execute(
+            text("SELECT ensure_visit_partitions(CAST(:months AS DATE[]))"),
+            {"months": sorted(months)},
+        )
+    _known_months.update(months)
+
+
+def ensure_future_visit_partitions(months_ahead: int = VISIT_PARTITIONS_AHEAD_MONTHS) -> None:
+    month = date.today().replace(day=1)
+    months = []
+    for _ in range(months_ahead + 1):
+        months.append(month)
+        month = date(month.year + month.month // 12, month.month % 12 + 1, 1)
+    ensure_visit_partitions(months)
+
+
+# Keeps the upcoming months created in a long-running API process, so the
+# ingestion does not have to take the visits lock to create them when a new
+# month starts
+class VisitPartitionScheduler:
+    def __init__(self) -> None:
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(VISIT_PARTITIONS_CHECK_SECONDS)
+            try:
+                await asyncio.to_thread(ensure_future_visit_partitions)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Creating the upcoming visit partitions failed")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+partition_scheduler = VisitPartitionScheduler()
@@ -1,43 +1,311 @@
-import tempfile
+import asyncio
+import gzip
+import io
+import queue
+import threading
+import time
+from contextlib import contextmanager
 from os import getenv
+from typing import BinaryIO, Callable, Iterator, Optional
 
 from boto3 import client
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError,
+    ConnectionClosedError,
+    EndpointConnectionError,
+    IncompleteReadError,
+    ReadTimeoutError,
+    ResponseStreamingError,
+)
+
+from services.csvio import take
+from services.metrics import S3_BYTES, instrument_s3_client
 
 S3_BUCKET = getenv("AWS_S3_BUCKET", "csv-uploads")
 S3_ENDPOINT_URL = getenv("AWS_S3_ENDPOINT_URL", "http://localstack:4566")
 AWS_REGION = getenv("AWS_REGION", "us-east-1")
 AWS_ACCESS_KEY_ID = getenv("AWS_ACCESS_KEY_ID", "test")
 AWS_SECRET_ACCESS_KEY = getenv("AWS_SECRET_ACCESS_KEY", "test")
+S3_STREAM_RETRIES = int(getenv("S3_STREAM_RETRIES", "5"))
+S3_STREAM_BUFFER_SIZE = int(getenv("S3_STREAM_BUFFER_SIZE", str(1024 * 1024)))
+S3_MAX_POOL_CONNECTIONS = int(getenv("S3_MAX_POOL_CONNECTIONS", "50"))
+S3_MAX_ATTEMPTS = int(getenv("S3_MAX_ATTEMPTS", "5"))
+S3_MULTIPART_THRESHOLD = int(getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+S3_MULTIPART_CHUNKSIZE = int(getenv("S3_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024)))
+S3_MAX_CONCURRENCY = int(getenv("S3_MAX_CONCURRENCY", "10"))
 
-def upload_csv(filepath: str, filename: str) -> str:
-    s3_client = client(
-        "s3",
-        region_name=AWS_REGION,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    )
+transfer_config = TransferConfig(
+    multipart_threshold=S3_MULTIPART_THRESHOLD,
+    multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+    max_concurrency=S3_MAX_CONCURRENCY,
+)
+
+# Errors after which a dropped object stream is re-opened with a Range request
+STREAM_RETRY_ERRORS = (
+    ConnectionClosedError,
+    EndpointConnectionError,
+    IncompleteReadError,
+    ReadTimeoutError,
+    ResponseStreamingError,
+)
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_s3_client():
+    # boto3 clients are thread-safe, so one client (and its connection pool)
+    # is shared by every activity in the process
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = client(
+                    "s3",
+                    region_name=AWS_REGION,
+                    endpoint_url=S3_ENDPOINT_URL,
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"},
+                    ),
+                )
+                instrument_s3_client(_client)
+    return _client
 
+
+def upload_stream(
+    stream: BinaryIO,
+    filename: str,
+    content_type: str = "text/csv",
+    progress: Optional[Callable[[int], None]] = None,
+    progress_every: int = S3_MULTIPART_CHUNKSIZE,
+) -> str:
+    uploaded = S3_BYTES.labels("upload")
+    total = [0, 0]
+
+    def callback(size: int) -> None:
+        uploaded.inc(size)
+        total[0] += size
+        if progress is not None and total[0] - total[1] >= progress_every:
+            total[1] = total[0]
+            progress(total[0])
+
+    # upload_fileobj switches to a multipart upload once the stream grows past
+    # the multipart threshold, reading one part at a time from `stream`
     s3_key = f"ingestions/{filename}"
-    s3_client.upload_file(str(filepath), S3_BUCKET, s3_key)
+    get_s3_client().upload_fileobj(
+        stream,
+        S3_BUCKET,
+        s3_key,
+        ExtraArgs={"ContentType": content_type},
+        Config=transfer_config,
+        Callback=callback,
+    )
 
     return f"s3://{S3_BUCKET}/{s3_key}"
 
 
-def download_csv(s3path: str) -> str:
+# Upload fed from async code: bytes passed to `write` are handed through a
+# bounded queue to upload_stream running in a worker thread, so at most
+# `max_chunks` chunks of `chunk_size` bytes are held in memory
+class StreamingUpload:
+    def __init__(
+        self,
+        filename: str,
+        content_type: str = "text/csv",
+        chunk_size: int = S3_MULTIPART_CHUNKSIZE,
+        max_chunks: int = 4,
+    ) -> None:
+        self.filename = filename
+        self._content_type = content_type
+        self._chunk_size = chunk_size
+        self._queue: queue.Queue = queue.Queue(max_chunks)
+        self._buffer = bytearray()
+        self._pending = bytearray()
+        self._eof = False
+        self._aborted = False
+        self._finished = threading.Event()
+        self._task = None
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._eof and (size < 0 or len(self._pending) < size):
+            chunk = self._queue.get()
+            if self._aborted:
+                raise IOError("Upload aborted")
+            if chunk is None:
+                self._eof = True
+            else:
+                self._pending += chunk
+        return take(self._pending, size)
+
+    def _upload(self) -> str:
+        try:
+            return upload_stream(self, self.filename, self._content_type)
+        finally:
+            self._finished.set()
+
+    def _put(self, chunk) -> None:
+        # Gives up once the upload thread is gone, whatever the reason
+        while not self._finished.is_set():
+            try:
+                self._queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    async def _send(self, chunk) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(asyncio.to_thread(self._upload))
+        await asyncio.to_thread(self._put, chunk)
+        if self._task.done():
+            # Surfaces the upload error
+            await self._task
+
+    async def write(self, data: bytes) -> None:
+        self._buffer += data
+        if len(self._buffer) >= self._chunk_size:
+            chunk = bytes(self._buffer)
+            self._buffer.clear()
+            await self._send(chunk)
+
+    async def close(self) -> str:
+        if self._buffer:
+            await self._send(bytes(self._buffer))
+            self._buffer.clear()
+        await self._send(None)
+        return await self._task
+
+    async def abort(self) -> None:
+        if self._task is None:
+            return
+        self._aborted = True
+        # Wakes the reader if it is waiting for data
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        try:
+            await self._task
+        except Exception:
+            pass
+
+
+def delete_object(s3path: str) -> None:
+    bucket, key = split_s3_path(s3path)
+    get_s3_client().delete_object(Bucket=bucket, Key=key)
+
+
+def object_size(s3path: str) -> int:
+    bucket, key = split_s3_path(s3path)
+    return get_s3_client().head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+
+def split_s3_path(s3path: str) -> tuple[str, str]:
     parts = s3path.replace("s3://", "").split("/", 1)
-    bucket = parts[0]
-    key = parts[1]
-
-    s3_client = client(
-        "s3",
-        region_name=AWS_REGION,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    )
+    return parts[0], parts[1]
+
+
+# Raw stream over an S3 object body. When the connection drops mid-object the
+# body is re-requested from the current position, so callers only ever see a
+# continuous byte stream.
+class S3ObjectStream(io.RawIOBase):
+    def __init__(self, s3_client, bucket: str, key: str, offset: int = 0) -> None:
+        self._client = s3_client
+        self._bucket = bucket
+        self._key = key
+        self._position = offset
+        self._body = None
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def _open(self) -> None:
+        kwargs = {"Bucket": self._bucket, "Key": self._key}
+        if self._position:
+            kwargs["Range"] = f"bytes={self._position}-"
+        try:
+            self._body = self._client.get_object(**kwargs)["Body"]
+        except ClientError as e:
+            # Resuming exactly at the end of the object
+            if e.response.get("Error", {}).get("Code") != "InvalidRange":
+                raise
+            self._eof = True
+
+    def _reset(self) -> None:
+        if self._body is not None:
+            self._body.close()
+        self._body = None
+
+    def readinto(self, buffer) -> int:
+        attempt = 0
+        while True:
+            if self._eof:
+                return 0
+            try:
+                if self._body is None:
+                    self._open()
+                    continue
+                data = self._body.read(len(buffer))
+                break
+            except STREAM_RETRY_ERRORS:
+                attempt += 1
+                if attempt > S3_STREAM_RETRIES:
+                    raise
+                self._reset()
+                time.sleep(min(2 ** attempt * 0.1, 5))
+
+        size = len(data)
+        buffer[:size] = data
+        self._position += size
+        S3_BYTES.labels("download").inc(size)
+        return size
+
+    def close(self) -> None:
+        self._reset()
+        super().close()
+
+
+# Whether the object is gzipped comes from the caller (detect_format), as
+# an object uploaded as application/gzip need not have a .gz key
+@contextmanager
+def open_csv_stream(
+    s3path: str,
+    offset: int = 0,
+    compressed: bool = False,
+    progress: Optional[Callable[[int], None]] = None,
+    progress_every: int = S3_MULTIPART_CHUNKSIZE,
+) -> Iterator[BinaryIO]:
+    bucket, key = split_s3_path(s3path)
+
+    # Offsets into gzip objects refer to the decompressed stream, which can
+    # only be reached by decompressing from the start of the object. That is
+    # done in chunks of `progress_every` bytes, reporting the bytes skipped
+    # so far after each, so a caller can heartbeat through a long skip.
+    with io.BufferedReader(
+        S3ObjectStream(get_s3_client(), bucket, key, 0 if compressed else offset),
+        buffer_size=S3_STREAM_BUFFER_SIZE,
+    ) as stream:
+        if not compressed:
+            yield stream
+            return
 
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".csv")
-    tmp.close()
-    s3_client.download_file(bucket, key, tmp.name)
-    return tmp.name
\ No newline at end of file
+        with gzip.GzipFile(fileobj=stream, mode="rb") as decompressed:
+            skipped = 0
+            while skipped < offset:
+                chunk = decompressed.read(min(progress_every, offset - skipped))
+                if not chunk:
+                    break
+                skipped += len(chunk)
+                if progress is not None:
+                    progress(skipped)
+            yield decompressed
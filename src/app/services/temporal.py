@@ -1,15 +1,35 @@
 from os import getenv
 from typing import Optional
-import hashlib
 
 from temporalio.client import Client
-from temporalio.service import RPCError, RPCStatusCode
+from temporalio.common import WorkflowIDConflictPolicy, WorkflowIDReusePolicy
+from temporalio.exceptions import WorkflowAlreadyStartedError
+
+from services.cache import MemoryCache
+from temporal.workflows.ingestion import ingestion_workflow_id
 
 temporal_address = getenv("TEMPORAL_ADDRESS", "temporal:7233")
 temporal_namespace = getenv("TEMPORAL_NAMESPACE", "default")
 bg_task_queue = getenv("BG_TASK_QUEUE", "background-task-queue")
 
+# Micro-batching of conversions: ingestions are handed to a long running
+# CsvBatchWorkflow instead of each starting its own CsvConversionWorkflow
+ingest_batching = getenv("INGEST_BATCHING", "false").lower() in ("1", "true", "yes")
+ingest_batch_size = int(getenv("INGEST_BATCH_SIZE", "500"))
+ingest_batch_window_seconds = float(getenv("INGEST_BATCH_WINDOW_SECONDS", "5"))
+ingest_batch_shards = int(getenv("INGEST_BATCH_SHARDS", "1"))
+
+# Number of MRN shards a large CSV is split into and ingested in parallel
+ingest_shards = int(getenv("INGEST_SHARDS", "1"))
+
+# Workflow ids this process started (or found running or completed) lately.
+# Hot duplicates skip the RPC entirely; a workflow failing after it was
+# cached is only started again once its entry expires.
+STARTED_CACHE_MAX_ENTRIES = int(getenv("WORKFLOW_START_CACHE_MAX_ENTRIES", "10000"))
+STARTED_CACHE_TTL_SECONDS = float(getenv("WORKFLOW_START_CACHE_TTL_SECONDS", "300"))
+
 _client: Optional[Client] = None
+_started = MemoryCache(STARTED_CACHE_MAX_ENTRIES, STARTED_CACHE_TTL_SECONDS)
 
 async def get_temporal_client() -> Client:
     global _client
@@ -20,48 +40,59 @@ async def get_temporal_client() -> Client:
         )
     return _client
 
-async def process_csv_file(s3path: str):
+# Starts the workflow in a single RPC: a running one with the same id is
+# reused, a completed one is left alone and a failed one is started again
+async def start_workflow_once(workflow: str, args: list, workflow_id: str) -> None:
+    if _started.get(workflow_id):
+        return
+
     client = await get_temporal_client()
-    
-    # Calculate MD5 hash of s3path to use as workflow_id
-    workflow_id = hashlib.md5(s3path.encode()).hexdigest()
-    
     try:
-        # Check if workflow already exists
-        handle = client.get_workflow_handle(workflow_id)
-        workflow_status = await handle.describe()
-        status = workflow_status.status.name.lower()
-        
-        # If status is completed, running, or terminated, do nothing
-        if status in ["completed", "running", "terminated"]:
-            return
-        
-        # If status is failed, retry the workflow
-        if status == "failed":
-            await handle.retry()
-            return
-    
-    except RPCError as e:
-        if e.status != RPCStatusCode.NOT_FOUND:
-            raise
-        # Workflow doesn't exist, start it
+        await client.start_workflow(
+            workflow,
+            args=args,
+            id=workflow_id,
+            task_queue=bg_task_queue,
+            id_reuse_policy=WorkflowIDReusePolicy.ALLOW_DUPLICATE_FAILED_ONLY,
+            id_conflict_policy=WorkflowIDConflictPolicy.USE_EXISTING,
+        )
+    except WorkflowAlreadyStartedError:
+        # Closed without failing; nothing left to do
         pass
-    
-    # Start the workflow if it doesn't exist
-    await client.start_workflow(
+    _started.set(workflow_id, True)
+
+async def process_csv_file(s3path: str):
+    await start_workflow_once(
         "CsvIngestionWorkflow",
-        s3path,
-        id=workflow_id,
-        task_queue=bg_task_queue,
+        [s3path, ingest_shards],
+        ingestion_workflow_id(s3path),
     )
 
 async def start_csv_conversion(entry_id: int):
-    client = await get_temporal_client()
-    workflow_id = f"ingest-{entry_id}"
+    if ingest_batching:
+        await add_to_conversion_batch(entry_id)
+        return
 
-    await client.start_workflow(
+    # The conversion starts the ingestion as a child workflow
+    await start_workflow_once(
         "CsvConversionWorkflow",
-        entry_id,
-        id=workflow_id,
+        [entry_id, ingest_shards],
+        f"ingest-{entry_id}",
+    )
+
+async def add_to_conversion_batch(entry_id: int):
+    client = await get_temporal_client()
+    # Signal-with-start: delivers the id to the shard's batch workflow,
+    # starting it first if it is not running
+    await client.start_workflow(
+        "CsvBatchWorkflow",
+        {
+            "max_size": ingest_batch_size,
+            "window_seconds": ingest_batch_window_seconds,
+            "shards": ingest_shards,
+        },
+        id=f"ingest-batch-{entry_id % ingest_batch_shards}",
         task_queue=bg_task_queue,
-    )
\ No newline at end of file
+        start_signal="add",
+        start_signal_args=[entry_id],
+    )
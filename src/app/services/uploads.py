@@ -0,0 +1,136 @@
+import csv
+import hashlib
+import json
+from json.encoder import encode_basestring_ascii
+from typing import AsyncIterator, List, Tuple
+
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+from typing_extensions import TypedDict
+
+from models import IngestItem
+
+
+def normalize_item(item: IngestItem) -> dict:
+    return {
+        "mrn": item.mrn,
+        "first_name": item.first_name,
+        "last_name": item.last_name,
+        "birth_date": item.birth_date.isoformat(),
+        "visit_account_number": item.visit_account_number,
+        "visit_date": item.visit_date.isoformat(),
+        "reason": item.reason,
+    }
+
+
+# Plain dicts with IngestItem's fields and types: validated by the same
+# pydantic-core rules but much cheaper to build than model instances
+IngestRecord = TypedDict(
+    "IngestRecord",
+    {name: field.annotation for name, field in IngestItem.model_fields.items()},
+)
+INGEST_RECORDS = TypeAdapter(List[IngestRecord])
+
+
+# Same text as json.dumps(item, sort_keys=True, separators=(",", ":")), with
+# the keys written in sorted order by hand and strings escaped by the C
+# encoder json.dumps itself uses
+def canonical_item(r: dict) -> str:
+    return (
+        f'{{"birth_date":"{r["birth_date"]}"'
+        f',"first_name":{encode_basestring_ascii(r["first_name"])}'
+        f',"last_name":{encode_basestring_ascii(r["last_name"])}'
+        f',"mrn":{encode_basestring_ascii(r["mrn"])}'
+        f',"reason":{encode_basestring_ascii(r["reason"])}'
+        f',"visit_account_number":{encode_basestring_ascii(r["visit_account_number"])}'
+        f',"visit_date":"{r["visit_date"]}"}}'
+    )
+
+
+def canonical_payload(body: bytes) -> str:
+    # Parses and validates the raw body in one pass inside pydantic-core;
+    # errors are reported the way FastAPI reports body validation errors
+    try:
+        records = INGEST_RECORDS.validate_json(body)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", *error["loc"])} for error in e.errors()]
+        )
+    return "[" + ",".join(map(canonical_item, records)) + "]"
+
+
+# MD5 of the same serialized JSON array /ingest hashes, built one item at a
+# time, so a payload gets the same md5_hash whichever endpoint received it
+class PayloadHasher:
+    def __init__(self) -> None:
+        self._md5 = hashlib.md5(b"[")
+        self._empty = True
+
+    def update(self, item: dict) -> None:
+        if not self._empty:
+            self._md5.update(b",")
+        self._md5.update(canonical_item(item).encode("utf-8"))
+        self._empty = False
+
+    def hexdigest(self) -> str:
+        md5 = self._md5.copy()
+        md5.update(b"]")
+        return md5.hexdigest()
+
+
+def invalid_record(line: int, error_type: str, message: str) -> RequestValidationError:
+    return RequestValidationError(
+        [{"type": error_type, "loc": ("body", line), "msg": message, "input": None}]
+    )
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield (line + b"\n").decode("utf-8")
+    if pending:
+        yield pending.decode("utf-8")
+
+
+async def ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, dict]]:
+    line_number = 0
+    async for line in _lines(chunks):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise invalid_record(line_number, "json_invalid", str(e))
+        if not isinstance(record, dict):
+            raise invalid_record(line_number, "model_type", "Each line must be a JSON object")
+        yield line_number, record
+
+
+async def csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, dict]]:
+    fieldnames = None
+    line_number = 0
+    record_line = 1
+    record = ""
+    async for line in _lines(chunks):
+        line_number += 1
+        record += line
+        # A quoted field may span lines; the record is complete once its
+        # quotes are balanced ("" escapes count twice, so parity holds)
+        if record.count('"') % 2:
+            continue
+
+        values = next(csv.reader([record]), [])
+        start, record_line, record = record_line, line_number + 1, ""
+        if not values:
+            continue
+        if fieldnames is None:
+            fieldnames = values
+            continue
+        yield start, dict(zip(fieldnames, values))
+
+    if record:
+        raise invalid_record(record_line, "csv_invalid", "Unterminated quoted field")
@@ -1,272 +1,383 @@
-import json
+import contextvars
+import hashlib
 import os
-from pathlib import Path
+import tempfile
+from pathlib import PurePosixPath
 
 from sqlalchemy import text
 from temporalio import activity
 
-from services.database import SessionLocal
-from services.s3 import upload_csv, download_csv
+from services.database import AsyncSessionLocal, SessionLocal
+from services.ingestion import (
+    INGEST_ROW_DEDUP,
+    ingest_csv_chunks,
+    ingest_parquet_chunks,
+    split_csv_by_mrn,
+)
+from services.csvio import CSV_HEADERS
+from services.formats import detect_format, open_parquet, upload_rows
+from services.s3 import (
+    delete_object,
+    object_size,
+    open_csv_stream,
+    split_s3_path,
+    upload_stream,
+)
 from services.temporal import process_csv_file as _process_csv_file
 
-UPLOAD_DIR = Path(os.getenv("UPLOADS_DIR", "uploads"))
+# Files smaller than this are ingested by a single activity even when the
+# workflow asks for shards
+INGEST_SHARD_MIN_BYTES = int(os.getenv("INGEST_SHARD_MIN_BYTES", str(64 * 1024 * 1024)))
 
+# Only the columns the workflow branches on; the payload never goes through
+# workflow history
 @activity.defn
-async def get_ingestion(entry_id: int) -> dict | None:
-    db = SessionLocal()
-    try:
+async def get_ingestion_status(entry_id: int) -> dict | None:
+    async with AsyncSessionLocal() as db:
         row = (
-            db.execute(
-                text(
-                    """
-                    SELECT id, payload, status, csv_filename, s3_path
-                    FROM ingestions
-                    WHERE id = :id
-                    """
-                ),
-                {"id": entry_id},
+            (
+                await db.execute(
+                    text(
+                        """
+                        SELECT status, s3_path
+                        FROM ingestions
+                        WHERE id = :id
+                        """
+                    ),
+                    {"id": entry_id},
+                )
             )
             .mappings()
             .first()
         )
         return dict(row) if row is not None else None
-    finally:
-        db.close()
 
 
+# Streams the payload rows of the given ingestions (in id order) to one
+# object in the intermediate format and marks them all as uploaded to it
+def _upload_ingestions(db, entry_ids: list[int], name: str) -> str:
+    # Account numbers whose last row matches what was last ingested for them
+    # are left out of the CSV entirely, as the ingestion would drop them
+    unchanged, unchanged_filter = "", ""
+    if INGEST_ROW_DEDUP:
+        unchanged = f"""
+            , unchanged AS (
+                SELECT last.visit_account_number
+                FROM (
+                    SELECT DISTINCT ON (item->>'visit_account_number')
+                        item->>'visit_account_number' AS visit_account_number,
+                        ingest_row_hash({", ".join(f"item->>'{c}'" for c in CSV_HEADERS)}) AS row_hash
+                    FROM items
+                    WHERE item->>'visit_account_number' IS NOT NULL
+                    ORDER BY item->>'visit_account_number', id DESC, position DESC
+                ) last
+                JOIN visit_row_hashes h
+                    ON h.visit_account_number = last.visit_account_number
+                   AND h.row_hash = last.row_hash
+            )
+        """
+        unchanged_filter = """
+            WHERE NOT EXISTS (
+                SELECT 1 FROM unchanged u
+                WHERE u.visit_account_number = item->>'visit_account_number'
+            )
+        """
+
+    # Let Postgres unpack the payloads and fetch them through a server-side
+    # cursor, so only one batch of rows is held in memory at a time
+    rows = db.execute(
+        text(
+            f"""
+            WITH items AS (
+                SELECT id, position, item
+                FROM ingestions,
+                    jsonb_array_elements(payload) WITH ORDINALITY AS items(item, position)
+                WHERE id = ANY(:ids)
+            )
+            {unchanged}
+            SELECT
+                item->>'mrn',
+                item->>'first_name',
+                item->>'last_name',
+                item->>'birth_date',
+                item->>'visit_account_number',
+                item->>'visit_date',
+                item->>'reason'
+            FROM items
+            {unchanged_filter}
+            ORDER BY id, position
+            """
+        ),
+        {"ids": entry_ids},
+        execution_options={"yield_per": 1000},
+    )
+
+    filename, s3_path = upload_rows(rows, name)
+
+    db.execute(
+        text(
+            """
+            UPDATE ingestions
+            SET status = 'uploaded',
+                csv_filename = :filename,
+                s3_path = :s3_path
+            WHERE id = ANY(:ids)
+            """
+        ),
+        {"ids": entry_ids, "filename": filename, "s3_path": s3_path},
+    )
+    db.commit()
+
+    return s3_path
+
+
+# Blocking activities (psycopg2 COPY/cursors, boto3) are plain functions that
+# the worker runs in its thread pool, so they never stall the event loop
 @activity.defn
-async def convert_to_csv_and_mark_converted(entry_id: int) -> str:
+def convert_and_upload_csv(entry_id: int) -> dict:
     db = SessionLocal()
     try:
-        row = (
-            db.execute(
-                text(
-                    "SELECT id, payload, status FROM ingestions WHERE id = :id"
-                ),
-                {"id": entry_id},
-            )
-            .mappings()
-            .first()
-        )
-        if row is None:
+        current = db.execute(
+            text("SELECT status, s3_path FROM ingestions WHERE id = :id"),
+            {"id": entry_id},
+        ).mappings().first()
+        if current is None:
             raise RuntimeError(f"Ingestion {entry_id} not found")
 
-        if row["status"] != "new":
-            return row["status"]
-
-        raw_payload = row["payload"]
-        if isinstance(raw_payload, str):
-            payload = json.loads(raw_payload)
-        else:
-            payload = raw_payload or []
-
-        UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
-        filename = f"ingestion_{entry_id}.csv"
-        filepath = UPLOAD_DIR / filename
-
-        headers = [
-            "mrn",
-            "first_name",
-            "last_name",
-            "birth_date",
-            "visit_account_number",
-            "visit_date",
-            "reason",
-        ]
-
-        # Write CSV file
-        import csv
-
-        with filepath.open("w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=headers)
-            writer.writeheader()
-            for item in payload:
-                writer.writerow(
-                    {
-                        "mrn": item.get("mrn"),
-                        "first_name": item.get("first_name"),
-                        "last_name": item.get("last_name"),
-                        "birth_date": item.get("birth_date"),
-                        "visit_account_number": item.get(
-                            "visit_account_number"
-                        ),
-                        "visit_date": item.get("visit_date"),
-                        "reason": item.get("reason"),
-                    }
-                )
-
-        db.execute(
-            text(
-                """
-                UPDATE ingestions
-                SET status = 'converted',
-                    csv_filename = :filename
-                WHERE id = :id
-                """
-            ),
-            {"id": entry_id, "filename": filename},
-        )
-        db.commit()
+        # 'converted' is left over from the old two-step pipeline and 'failed'
+        # from an earlier failed attempt; the payload is still in the
+        # database, so it is simply converted again
+        if current["status"] not in ("new", "converted", "failed"):
+            return dict(current)
 
-        return "converted"
+        s3_path = _upload_ingestions(db, [entry_id], f"ingestion_{entry_id}")
+        return {"status": "uploaded", "s3_path": s3_path}
     finally:
         db.close()
 
 
+# Only used by workflow histories recorded before get_ingestion_status, and
+# by the two-step pipeline below; kept until those have drained
 @activity.defn
-async def upload_csv_to_s3_and_mark_uploaded(entry_id: int) -> str:
-    db = SessionLocal()
-    try:
-        row = (
-            db.execute(
+async def get_ingestion(entry_id: int) -> dict | None:
+    return await get_ingestion_status(entry_id)
+
+
+# The two-step pipeline, only used by workflow histories recorded before
+# conversion and upload became one activity; kept until those have drained.
+# The payload stays in the database, so "converting" only moves the status on
+# and the upload step does the actual conversion.
+@activity.defn
+async def convert_to_csv_and_mark_converted(entry_id: int) -> str:
+    async with AsyncSessionLocal() as db:
+        status = (
+            await db.execute(
                 text(
                     """
-                    SELECT id, status, csv_filename
-                    FROM ingestions
+                    UPDATE ingestions
+                    SET status = CASE WHEN status = 'new' THEN 'converted' ELSE status END
                     WHERE id = :id
+                    RETURNING status
                     """
                 ),
                 {"id": entry_id},
             )
-            .mappings()
-            .first()
-        )
-        if row is None:
-            raise RuntimeError(f"Ingestion {entry_id} not found")
+        ).scalar_one_or_none()
+        await db.commit()
+    if status is None:
+        raise RuntimeError(f"Ingestion {entry_id} not found")
+    return status
 
-        if row["status"] != "converted":
-            return row["status"]
 
-        filename = row["csv_filename"]
-        if not filename:
-            raise RuntimeError(
-                f"Ingestion {entry_id} has no CSV filename recorded"
-            )
-
-        filepath = UPLOAD_DIR / filename
-        if not filepath.exists():
-            raise RuntimeError(
-                f"CSV file for ingestion {entry_id} not found at {filepath}"
-            )
+@activity.defn
+def upload_csv_to_s3_and_mark_uploaded(entry_id: int) -> str:
+    return convert_and_upload_csv(entry_id)["status"]
 
-        s3_path = upload_csv(filepath, filename)
 
-        db.execute(
+@activity.defn
+def convert_and_upload_batch(entry_ids: list[int]) -> list[str]:
+    db = SessionLocal()
+    try:
+        current = db.execute(
             text(
                 """
-                UPDATE ingestions
-                SET status = 'uploaded',
-                    s3_path = :s3_path
-                WHERE id = :id
+                SELECT id, status, s3_path
+                FROM ingestions
+                WHERE id = ANY(:ids)
+                ORDER BY id
                 """
             ),
-            {"id": entry_id, "s3_path": s3_path},
-        )
-        db.commit()
-
-        return "uploaded"
+            {"ids": entry_ids},
+        ).mappings().all()
+
+        pending = [r["id"] for r in current if r["status"] in ("new", "converted", "failed")]
+        # Ingestions uploaded earlier (resubmitted payloads, or a retry after
+        # the upload committed) are handed back so they get ingested too
+        s3_paths = sorted({r["s3_path"] for r in current if r["status"] == "uploaded"})
+
+        if pending:
+            # Named after its members so a retried attempt overwrites the same
+            # object instead of leaving a second copy behind
+            digest = hashlib.md5(",".join(map(str, pending)).encode()).hexdigest()[:12]
+            name = f"ingestion_batch_{pending[0]}_{digest}"
+            s3_paths.append(_upload_ingestions(db, pending, name))
+
+        return s3_paths
     finally:
         db.close()
 
 
+# Only used by workflow histories recorded before the ingestion was started
+# as a child workflow
 @activity.defn
 async def process_csv_file(s3path: str) -> None:
     await _process_csv_file(s3path)
 
 
+def _last_checkpoint() -> dict | None:
+    details = activity.info().heartbeat_details
+    return details[0] if details else None
+
+
+# Heartbeats with the given checkpoint (so a retry still resumes from it)
+# from threads outside the activity's context, such as boto3's transfer
+# threads
+def _threaded_heartbeat(checkpoint: dict | None):
+    context = contextvars.copy_context()
+    details = () if checkpoint is None else (checkpoint,)
+    return lambda *_: context.copy().run(activity.heartbeat, *details)
+
+
 @activity.defn
-async def ingest_csv_from_s3(s3path: str) -> str:
-    local_path = download_csv(s3path)
+def ingest_csv_from_s3(s3path: str) -> str:
+    # Resume from the last committed chunk when this is a retry
+    checkpoint = _last_checkpoint()
+    offset = checkpoint.get("offset", 0) if checkpoint is not None else 0
     db = SessionLocal()
     try:
-        import csv as csv_mod
-
-        with open(local_path, newline="", encoding="utf-8") as f:
-            reader = csv_mod.DictReader(f)
-            for row in reader:
-                # Check if patient already exists
-                existing = db.execute(
-                    text("SELECT id FROM patients WHERE mrn = :mrn"),
-                    {"mrn": row["mrn"]},
-                ).scalar()
-
-                if existing is not None:
-                    patient_id = existing
-                    db.execute(
-                        text(
-                            """
-                            INSERT INTO persons (id, first_name, last_name, birth_date)
-                            VALUES (:id, :first_name, :last_name, :birth_date)
-                            ON CONFLICT (id) DO UPDATE SET
-                                first_name = COALESCE(EXCLUDED.first_name, persons.first_name),
-                                last_name = COALESCE(EXCLUDED.last_name, persons.last_name),
-                                birth_date = COALESCE(EXCLUDED.birth_date, persons.birth_date)
-                            """
-                        ),
-                        {
-                            "id": patient_id,
-                            "first_name": row["first_name"] or None,
-                            "last_name": row["last_name"] or None,
-                            "birth_date": row["birth_date"] or None,
-                        },
-                    )
-                else:
-                    # New patient: get next id from sequence
-                    patient_id = db.execute(
-                        text("SELECT nextval('patients_id_seq')")
-                    ).scalar()
-                    # Insert person first (FK: patients.id → persons.id)
-                    db.execute(
-                        text(
-                            """
-                            INSERT INTO persons (id, first_name, last_name, birth_date)
-                            VALUES (:id, :first_name, :last_name, :birth_date)
-                            """
-                        ),
-                        {
-                            "id": patient_id,
-                            "first_name": row["first_name"] or None,
-                            "last_name": row["last_name"] or None,
-                            "birth_date": row["birth_date"] or None,
-                        },
-                    )
-                    # Insert patient with the same id
-                    db.execute(
-                        text(
-                            "INSERT INTO patients (id, mrn) VALUES (:id, :mrn)"
-                        ),
-                        {"id": patient_id, "mrn": row["mrn"]},
-                    )
-
-                # Insert visit (skip duplicates)
-                db.execute(
-                    text(
-                        """
-                        INSERT INTO visits (visit_account_number, patient_id, visit_date, reason)
-                        VALUES (:visit_account_number, :patient_id, :visit_date, :reason)
-                        ON CONFLICT (visit_account_number) DO NOTHING
-                        """
-                    ),
-                    {
-                        "visit_account_number": row["visit_account_number"],
-                        "patient_id": patient_id,
-                        "visit_date": row["visit_date"],
-                        "reason": row["reason"],
-                    },
-                )
+        fmt = detect_format(s3path)
+        if fmt == "parquet":
+            with open_parquet(s3path, progress=_threaded_heartbeat(checkpoint)) as parquet:
+                for checkpoint in ingest_parquet_chunks(db, parquet, checkpoint):
+                    activity.heartbeat(checkpoint)
+            return "ingested"
+
+        with open_csv_stream(
+            s3path,
+            offset,
+            compressed=fmt == "csv.gz",
+            progress=_threaded_heartbeat(checkpoint),
+        ) as stream:
+            for checkpoint in ingest_csv_chunks(db, stream, checkpoint):
+                activity.heartbeat(checkpoint)
 
-        db.commit()
         return "ingested"
     finally:
         db.close()
-        os.unlink(local_path)
+
+
+@activity.defn
+def split_csv_file(s3path: str, shards: int) -> list[str]:
+    # Small files are not worth the extra pass; they are ingested as they are.
+    # Parquet objects are already read in row groups and are not split.
+    if shards <= 1 or object_size(s3path) < INGEST_SHARD_MIN_BYTES:
+        return [s3path]
+    fmt = detect_format(s3path)
+    if fmt == "parquet":
+        return [s3path]
+
+    # Shard objects are named after the source file, so a retried attempt
+    # overwrites the same objects
+    _, key = split_s3_path(s3path)
+    stem = PurePosixPath(key).name.split(".")[0]
+
+    # Shards are spooled to local temp files and uploaded one after another
+    outputs = [
+        tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+        for _ in range(shards)
+    ]
+    try:
+        with open_csv_stream(s3path, compressed=fmt == "csv.gz") as stream:
+            counts = split_csv_by_mrn(
+                stream, outputs, progress=lambda rows: activity.heartbeat(rows)
+            )
+
+        s3_paths = []
+        for index, (output, count) in enumerate(zip(outputs, counts)):
+            if not count:
+                continue
+            output.flush()
+            output.buffer.seek(0)
+            # boto3 reports progress from its transfer threads, so a large
+            # shard keeps heartbeating while its parts are uploaded
+            s3_paths.append(
+                upload_stream(
+                    output.buffer,
+                    f"shards/{stem}/part-{index:03d}-of-{shards:03d}.csv",
+                    progress=_threaded_heartbeat(None),
+                )
+            )
+            activity.heartbeat(index)
+        return s3_paths
+    finally:
+        for output in outputs:
+            output.close()
+
+
+@activity.defn
+def delete_s3_objects(s3_paths: list[str]) -> None:
+    for s3_path in s3_paths:
+        delete_object(s3_path)
+
+
+# Every ingestion converted into the object (several when batched) is done
+# once the object is; the status change is published by the ingestions trigger
+@activity.defn
+async def mark_ingested(s3path: str) -> None:
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            text(
+                """
+                UPDATE ingestions
+                SET status = 'ingested'
+                WHERE s3_path = :s3_path AND status = 'uploaded'
+                """
+            ),
+            {"s3_path": s3path},
+        )
+        await db.commit()
+
+
+# Ingestions whose conversion kept failing; submitting the payload again
+# retries them
+@activity.defn
+async def mark_failed(entry_id: int) -> None:
+    async with AsyncSessionLocal() as db:
+        await db.execute(
+            text(
+                """
+                UPDATE ingestions
+                SET status = 'failed'
+                WHERE id = :id AND status IN ('new', 'converted')
+                """
+            ),
+            {"id": entry_id},
+        )
+        await db.commit()
 
 
 __all__ = [
+    "get_ingestion_status",
+    "convert_and_upload_csv",
+    "convert_and_upload_batch",
     "get_ingestion",
     "convert_to_csv_and_mark_converted",
     "upload_csv_to_s3_and_mark_uploaded",
     "process_csv_file",
     "ingest_csv_from_s3",
+    "split_csv_file",
+    "delete_s3_objects",
+    "mark_ingested",
+    "mark_failed",
 ]
 
@@ -1,53 +1,154 @@
+import multiprocessing
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from os import getenv
-from asyncio import run
+from os import cpu_count, getenv
+from asyncio import gather, run
 from temporalio.client import Client
-from temporalio.worker import Worker
+from temporalio.worker import SharedStateManager, Worker
 
 # Ensure the app root (parent of `temporal/`) is on sys.path so `services` is importable
 BASE_DIR = Path(__file__).resolve().parent.parent
 if str(BASE_DIR) not in sys.path:
     sys.path.insert(0, str(BASE_DIR))
 
+from workflows.batch import CsvBatchWorkflow
 from workflows.conversion import CsvConversionWorkflow
 from workflows.ingestion import CsvIngestionWorkflow
+from workflows.queues import CONVERSION, INGESTION, role_queue
+from services.database import pool_options
+from services.metrics import ActivityMetricsInterceptor, start_worker_metrics_server
 from temporal.activities import (
+    get_ingestion_status,
+    convert_and_upload_csv,
+    convert_and_upload_batch,
     get_ingestion,
     convert_to_csv_and_mark_converted,
     upload_csv_to_s3_and_mark_uploaded,
     process_csv_file,
     ingest_csv_from_s3,
+    split_csv_file,
+    delete_s3_objects,
+    mark_ingested,
+    mark_failed,
 )
 
+# The "workflow" role polls BG_TASK_QUEUE itself: it runs the workflows and the
+# short bookkeeping activities. The other roles poll "<BG_TASK_QUEUE>-<role>".
+WORKFLOW = "workflow"
+ROLES = (WORKFLOW, CONVERSION, INGESTION)
+
+
+def worker_roles() -> list[str]:
+    # Every role by default; split them across deployments to scale the
+    # conversion and ingestion stages independently
+    return [
+        role.strip()
+        for role in getenv("WORKER_ROLES", ",".join(ROLES)).split(",")
+        if role.strip()
+    ]
+
+
+def conversion_processes() -> int | None:
+    if getenv("CONVERSION_EXECUTOR", "thread") != "process":
+        return None
+    return int(getenv("CONVERSION_PROCESSES", str(cpu_count() or 1)))
+
+
+def role_concurrency(role: str) -> int:
+    processes = conversion_processes()
+    if role == CONVERSION and processes is not None:
+        return int(getenv("CONVERSION_MAX_CONCURRENT_ACTIVITIES", str(processes)))
+    if role == INGESTION:
+        # Every running ingestion holds a connection of the sync engine, so
+        # by default no more run than its pool keeps open
+        return int(
+            getenv("INGESTION_MAX_CONCURRENT_ACTIVITIES", str(pool_options["pool_size"]))
+        )
+    return int(
+        getenv(
+            f"{role.upper()}_MAX_CONCURRENT_ACTIVITIES",
+            getenv("MAX_CONCURRENT_ACTIVITIES", "100"),
+        )
+    )
+
+
+ROLE_ACTIVITIES = {
+    WORKFLOW: [
+        get_ingestion_status,
+        process_csv_file,
+        # Replayed by workflow histories from before the single conversion
+        # activity and the status-only lookup
+        get_ingestion,
+        convert_to_csv_and_mark_converted,
+        upload_csv_to_s3_and_mark_uploaded,
+        delete_s3_objects,
+        mark_ingested,
+        mark_failed,
+    ],
+    # CPU and S3 heavy: encoding, compressing and splitting files
+    CONVERSION: [convert_and_upload_csv, convert_and_upload_batch, split_csv_file],
+    # Database heavy: one connection per running activity
+    INGESTION: [ingest_csv_from_s3],
+}
+
+
+def create_worker(client: Client, task_queue: str, role: str) -> Worker:
+    concurrency = role_concurrency(role)
+    processes = conversion_processes()
+    options = {}
+
+    if role == CONVERSION and processes is not None:
+        # Separate processes sidestep the GIL for CSV/Parquet encoding; a
+        # fresh (spawned) interpreter shares no DB or S3 connections with
+        # this one. Heartbeats reach the worker through a manager process.
+        context = multiprocessing.get_context("spawn")
+        options["activity_executor"] = ProcessPoolExecutor(processes, mp_context=context)
+        options["shared_state_manager"] = SharedStateManager.create_from_multiprocessing(
+            context.Manager()
+        )
+    else:
+        # Sync activities run here; sized so every activity slot gets a thread
+        options["activity_executor"] = ThreadPoolExecutor(max_workers=concurrency)
+
+    if role == WORKFLOW:
+        options["workflows"] = [
+            CsvConversionWorkflow,
+            CsvBatchWorkflow,
+            CsvIngestionWorkflow,
+        ]
+        options["max_concurrent_workflow_tasks"] = int(
+            getenv("MAX_CONCURRENT_WORKFLOW_TASKS", "100")
+        )
+
+    return Worker(
+        client,
+        task_queue=task_queue if role == WORKFLOW else role_queue(task_queue, role),
+        activities=ROLE_ACTIVITIES[role],
+        max_concurrent_activities=concurrency,
+        interceptors=[ActivityMetricsInterceptor()],
+        **options,
+    )
+
+
 async def main() -> None:
     address = getenv("TEMPORAL_ADDRESS", "temporal:7233")
     namespace = getenv("TEMPORAL_NAMESPACE", "default")
     csvTaskQueue = getenv("BG_TASK_QUEUE", "background-task-queue")
+    roles = worker_roles()
+    unknown = set(roles) - set(ROLE_ACTIVITIES)
+    if unknown:
+        raise ValueError(f"Unknown WORKER_ROLES: {', '.join(sorted(unknown))}")
 
     client = await Client.connect(address, namespace=namespace)
 
-    # Run a worker for the same task queue the API uses
-    worker = Worker(
-        client,
-        task_queue=csvTaskQueue,
-        workflows=[
-            CsvConversionWorkflow,
-            CsvIngestionWorkflow,
-        ],
-        activities=[
-            get_ingestion,
-            convert_to_csv_and_mark_converted,
-            upload_csv_to_s3_and_mark_uploaded,
-            process_csv_file,
-            ingest_csv_from_s3,
-        ],
-    )
+    start_worker_metrics_server()
+    workers = [create_worker(client, csvTaskQueue, role) for role in roles]
 
-    print(f"Temporal worker started on '{csvTaskQueue}'")
-    await worker.run()
+    for worker in workers:
+        print(f"Temporal worker started on '{worker.task_queue}'")
+    await gather(*(worker.run() for worker in workers))
 
 
 if __name__ == "__main__":
     run(main())
-
@@ -1,7 +1,9 @@
+from temporal.workflows.batch import CsvBatchWorkflow
 from temporal.workflows.conversion import CsvConversionWorkflow
 from temporal.workflows.ingestion import CsvIngestionWorkflow
 
 __all__ = [
+    "CsvBatchWorkflow",
     "CsvConversionWorkflow",
     "CsvIngestionWorkflow",
 ]
@@ -0,0 +1,118 @@
+import asyncio
+from datetime import timedelta
+from temporalio import workflow
+from temporalio.common import RetryPolicy
+from temporalio.exceptions import ActivityError
+
+from .ingestion import start_ingestion
+from .queues import CONVERSION, activity_queue
+
+# Collects ingestion ids sent through the `add` signal and converts them in
+# batches: one CSV, one S3 object and one CsvIngestionWorkflow per batch
+# instead of per ingestion. A batch is flushed once it has `max_size`
+# ingestions or `window_seconds` after its first ingestion arrived. When a
+# batch fails, its ingestions are converted one by one and those that still
+# fail are marked failed, so one bad payload does not stall the batcher.
+@workflow.defn
+class CsvBatchWorkflow:
+    def __init__(self) -> None:
+        self._pending: list[int] = []
+
+    @workflow.signal
+    def add(self, entry_id: int) -> None:
+        if entry_id not in self._pending:
+            self._pending.append(entry_id)
+
+    async def _convert(self, entry_id: int) -> str | None:
+        try:
+            ingestion = await workflow.execute_activity(
+                "convert_and_upload_csv",
+                entry_id,
+                task_queue=activity_queue(CONVERSION),
+                schedule_to_close_timeout=timedelta(minutes=10),
+                retry_policy=RetryPolicy(
+                    initial_interval=timedelta(seconds=1),
+                    backoff_coefficient=2.0,
+                    maximum_interval=timedelta(seconds=30),
+                    maximum_attempts=3,
+                ),
+            )
+        except ActivityError:
+            workflow.logger.warning("Conversion of ingestion %d failed, marking it failed", entry_id)
+            await workflow.execute_activity(
+                "mark_failed",
+                entry_id,
+                schedule_to_close_timeout=timedelta(seconds=30),
+                retry_policy=RetryPolicy(
+                    initial_interval=timedelta(seconds=1),
+                    backoff_coefficient=2.0,
+                    maximum_interval=timedelta(seconds=10),
+                    maximum_attempts=5,
+                ),
+            )
+            return None
+        return ingestion["s3_path"] if ingestion["status"] == "uploaded" else None
+
+    async def _convert_each(self, batch: list[int]) -> list[str]:
+        s3_paths = await asyncio.gather(*(self._convert(entry_id) for entry_id in batch))
+        return list(dict.fromkeys(p for p in s3_paths if p is not None))
+
+    @workflow.run
+    async def run(self, options: dict) -> None:
+        max_size = options["max_size"]
+        window = timedelta(seconds=options["window_seconds"])
+        # Ids carried over from the previous run go first
+        self._pending = options.get("pending", []) + self._pending
+
+        while True:
+            await workflow.wait_condition(lambda: bool(self._pending))
+            try:
+                await workflow.wait_condition(
+                    lambda: len(self._pending) >= max_size, timeout=window
+                )
+            except asyncio.TimeoutError:
+                pass
+
+            batch = self._pending[:max_size]
+            try:
+                s3_paths = await workflow.execute_activity(
+                    "convert_and_upload_batch",
+                    batch,
+                    task_queue=activity_queue(CONVERSION),
+                    schedule_to_close_timeout=timedelta(minutes=10),
+                    retry_policy=RetryPolicy(
+                        initial_interval=timedelta(seconds=1),
+                        backoff_coefficient=2.0,
+                        maximum_interval=timedelta(seconds=30),
+                        maximum_attempts=5,
+                    ),
+                )
+            except ActivityError:
+                # Histories recorded before a failed batch was split up
+                if not workflow.patched("batch-conversion-fallback"):
+                    raise
+                workflow.logger.warning("Batch of %d ingestions failed, converting them one by one", len(batch))
+                s3_paths = await self._convert_each(batch)
+            for s3_path in s3_paths:
+                if workflow.patched("ingestion-child-workflow"):
+                    await start_ingestion(s3_path, options.get("shards", 1))
+                    continue
+
+                # Histories recorded before the ingestion became a child workflow
+                await workflow.execute_activity(
+                    "process_csv_file",
+                    s3_path,
+                    schedule_to_close_timeout=timedelta(minutes=1),
+                    retry_policy=RetryPolicy(
+                        initial_interval=timedelta(seconds=1),
+                        backoff_coefficient=2.0,
+                        maximum_interval=timedelta(seconds=30),
+                        maximum_attempts=5,
+                    ),
+                )
+            del self._pending[:len(batch)]
+
+            # Signals keep growing the history; start over with what is
+            # still pending before it gets too large
+            if workflow.info().is_continue_as_new_suggested():
+                workflow.continue_as_new({**options, "pending": self._pending})
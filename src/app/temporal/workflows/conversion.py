@@ -2,12 +2,79 @@ from datetime import timedelta
 from temporalio import workflow
 from temporalio.common import RetryPolicy
 
+from .ingestion import start_ingestion
+from .queues import CONVERSION, activity_queue
+
 @workflow.defn
 class CsvConversionWorkflow:
     @workflow.run
-    async def run(self, entry_id: int) -> str:
-        ingestion = await workflow.execute_activity(
-            "get_ingestion",
+    async def run(self, entry_id: int, shards: int = 1) -> str:
+        # Histories recorded while conversion and upload were two activities,
+        # each followed by a lookup, replay that sequence
+        if not workflow.patched("single-conversion-activity"):
+            return await self._run_two_step(entry_id)
+
+        # Histories recorded before the status-only lookup read the ingestion
+        # with get_ingestion, and again after the conversion
+        status_lookup = workflow.patched("ingestion-status-lookup")
+        ingestion = await self._lookup(
+            entry_id, "get_ingestion_status" if status_lookup else "get_ingestion"
+        )
+
+        if ingestion is None:
+            raise RuntimeError(f"Ingestion {entry_id} does not exist")
+
+        status = ingestion["status"]
+
+        # The conversion returns the state it left the ingestion in, so no
+        # second lookup is needed
+        if status in ("new", "converted", "failed"):
+            ingestion = await workflow.execute_activity(
+                "convert_and_upload_csv",
+                entry_id,
+                task_queue=activity_queue(CONVERSION),
+                schedule_to_close_timeout=timedelta(minutes=10),
+                retry_policy=RetryPolicy(
+                    initial_interval=timedelta(seconds=1),
+                    backoff_coefficient=2.0,
+                    maximum_interval=timedelta(seconds=30),
+                    maximum_attempts=5,
+                ),
+            )
+            if not status_lookup:
+                ingestion = await self._lookup(entry_id, "get_ingestion")
+            status = ingestion["status"] if ingestion else None
+
+        if status == "uploaded":
+            if workflow.patched("ingestion-child-workflow"):
+                await start_ingestion(ingestion["s3_path"], shards)
+                return "uploaded"
+
+            # Histories recorded before the ingestion became a child workflow
+            await workflow.execute_activity(
+                "process_csv_file",
+                ingestion["s3_path"],
+                schedule_to_close_timeout=timedelta(minutes=1),
+                retry_policy=RetryPolicy(
+                    initial_interval=timedelta(seconds=1),
+                    backoff_coefficient=2.0,
+                    maximum_interval=timedelta(seconds=30),
+                    maximum_attempts=5,
+                ),
+            )
+            return "uploaded"
+
+        # Resubmitted payload whose rows are already in the database
+        if status == "ingested":
+            return "ingested"
+
+        raise RuntimeError(
+            f"Ingestion {entry_id} has unsupported or unexpected status '{status}'"
+        )
+
+    async def _lookup(self, entry_id: int, activity: str = "get_ingestion") -> dict | None:
+        return await workflow.execute_activity(
+            activity,
             entry_id,
             schedule_to_close_timeout=timedelta(seconds=30),
             retry_policy=RetryPolicy(
@@ -18,6 +85,8 @@ class CsvConversionWorkflow:
             ),
         )
 
+    async def _run_two_step(self, entry_id: int) -> str:
+        ingestion = await self._lookup(entry_id)
         if ingestion is None:
             raise RuntimeError(f"Ingestion {entry_id} does not exist")
 
@@ -35,24 +104,14 @@ class CsvConversionWorkflow:
                     maximum_attempts=5,
                 ),
             )
-            ingestion = await workflow.execute_activity(
-                "get_ingestion",
-                entry_id,
-                schedule_to_close_timeout=timedelta(seconds=30),
-                retry_policy=RetryPolicy(
-                    initial_interval=timedelta(seconds=1),
-                    backoff_coefficient=2.0,
-                    maximum_interval=timedelta(seconds=10),
-                    maximum_attempts=5,
-                ),
-            )
+            ingestion = await self._lookup(entry_id)
             status = ingestion["status"] if ingestion else None
 
         if status == "converted":
             await workflow.execute_activity(
                 "upload_csv_to_s3_and_mark_uploaded",
                 entry_id,
-                schedule_to_close_timeout=timedelta(minutes=1),
+                schedule_to_close_timeout=timedelta(minutes=10),
                 retry_policy=RetryPolicy(
                     initial_interval=timedelta(seconds=1),
                     backoff_coefficient=2.0,
@@ -60,17 +119,7 @@ class CsvConversionWorkflow:
                     maximum_attempts=5,
                 ),
             )
-            ingestion = await workflow.execute_activity(
-                "get_ingestion",
-                entry_id,
-                schedule_to_close_timeout=timedelta(seconds=30),
-                retry_policy=RetryPolicy(
-                    initial_interval=timedelta(seconds=1),
-                    backoff_coefficient=2.0,
-                    maximum_interval=timedelta(seconds=10),
-                    maximum_attempts=5,
-                ),
-            )
+            ingestion = await self._lookup(entry_id)
             status = ingestion["status"] if ingestion else None
 
         if status == "uploaded":
@@ -89,4 +138,4 @@ class CsvConversionWorkflow:
 
         raise RuntimeError(
             f"Ingestion {entry_id} has unsupported or unexpected status '{status}'"
-        )
\ No newline at end of file
+        )
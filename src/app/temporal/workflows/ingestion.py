@@ -1,15 +1,81 @@
+import asyncio
+import hashlib
 from datetime import timedelta
 from temporalio import workflow
-from temporalio.common import RetryPolicy
+from temporalio.common import RetryPolicy, WorkflowIDReusePolicy
+from temporalio.exceptions import WorkflowAlreadyStartedError
+
+from .queues import CONVERSION, INGESTION, activity_queue
 
 @workflow.defn
 class CsvIngestionWorkflow:
     @workflow.run
-    async def run(self, s3path: str) -> str:
-        result = await workflow.execute_activity(
+    async def run(self, s3path: str, shards: int = 1) -> str:
+        if shards <= 1:
+            await self._ingest(s3path)
+            return await self._mark_ingested(s3path)
+
+        # Fan out: the file is split by MRN hash, so every patient is handled
+        # by exactly one shard, and the shards are ingested in parallel by
+        # whichever workers pick them up
+        shard_paths = await workflow.execute_activity(
+            "split_csv_file",
+            args=[s3path, shards],
+            task_queue=activity_queue(CONVERSION),
+            start_to_close_timeout=timedelta(hours=1),
+            heartbeat_timeout=timedelta(minutes=2),
+            retry_policy=RetryPolicy(maximum_attempts=5),
+        )
+
+        await asyncio.gather(*(self._ingest(path) for path in shard_paths))
+
+        if shard_paths != [s3path]:
+            await workflow.execute_activity(
+                "delete_s3_objects",
+                shard_paths,
+                start_to_close_timeout=timedelta(minutes=5),
+                retry_policy=RetryPolicy(maximum_attempts=5),
+            )
+        return await self._mark_ingested(s3path)
+
+    async def _mark_ingested(self, s3path: str) -> str:
+        if workflow.patched("mark-ingested"):
+            await workflow.execute_activity(
+                "mark_ingested",
+                s3path,
+                start_to_close_timeout=timedelta(seconds=30),
+                retry_policy=RetryPolicy(maximum_attempts=5),
+            )
+        return "ingested"
+
+    async def _ingest(self, s3path: str) -> str:
+        return await workflow.execute_activity(
             "ingest_csv_from_s3",
             s3path,
-            start_to_close_timeout=timedelta(minutes=10),
-            retry_policy=RetryPolicy(maximum_attempts=3),
+            task_queue=activity_queue(INGESTION),
+            start_to_close_timeout=timedelta(hours=2),
+            heartbeat_timeout=timedelta(minutes=2),
+            retry_policy=RetryPolicy(maximum_attempts=5),
+        )
+
+
+# One ingestion workflow per object, whichever path starts it
+def ingestion_workflow_id(s3path: str) -> str:
+    return hashlib.md5(s3path.encode()).hexdigest()
+
+
+# Starts the ingestion of an uploaded object as a child of the calling
+# workflow. The child is abandoned, so it outlives the parent (and its
+# continue-as-new); an ingestion already running or completed for the object
+# is left alone, a failed one is started again.
+async def start_ingestion(s3path: str, shards: int) -> None:
+    try:
+        await workflow.start_child_workflow(
+            CsvIngestionWorkflow.run,
+            args=[s3path, shards],
+            id=ingestion_workflow_id(s3path),
+            parent_close_policy=workflow.ParentClosePolicy.ABANDON,
+            id_reuse_policy=WorkflowIDReusePolicy.ALLOW_DUPLICATE_FAILED_ONLY,
         )
-        return result
+    except WorkflowAlreadyStartedError:
+        pass
@@ -0,0 +1,15 @@
+from temporalio import workflow
+
+# Heavy activities run on their own task queues, derived from the queue the
+# workflows run on (e.g. "background-task-queue-ingestion"), so each stage can
+# be given its own workers and concurrency limits.
+CONVERSION = "conversion"
+INGESTION = "ingestion"
+
+
+def role_queue(task_queue: str, role: str) -> str:
+    return f"{task_queue}-{role}"
+
+
+def activity_queue(role: str) -> str:
+    return role_queue(workflow.info().task_queue, role)
@@ -0,0 +1,111 @@
+# Tests that need Postgres use the database at DATABASE_URL (migrated on
+# first use) and are skipped when it cannot be reached. Every test runs in a
+# transaction that is rolled back afterwards; commits made by the code under
+# test only release a savepoint.
+import uuid
+from contextlib import asynccontextmanager
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+
+from services.database import ASYNC_DATABASE_URL, engine
+from services.migrations import migrate
+
+
+@pytest.fixture(scope="session")
+def migrated() -> None:
+    try:
+        migrate()
+    except OperationalError as e:
+        pytest.skip(f"Database not available: {e}")
+
+
+@pytest.fixture
+def db(migrated):
+    connection = engine.connect()
+    transaction = connection.begin()
+    session = Session(bind=connection, join_transaction_mode="create_savepoint")
+    try:
+        yield session
+    finally:
+        session.close()
+        transaction.rollback()
+        connection.close()
+
+
+@pytest.fixture
+def async_db(migrated):
+    # The same for async code, entered with `async with async_db() as session`
+    # inside the test's event loop: asyncpg connections cannot outlive the
+    # loop they were opened in, so each use gets an engine of its own
+    @asynccontextmanager
+    async def session():
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=NullPool)
+        try:
+            async with async_engine.connect() as connection:
+                transaction = await connection.begin()
+                db = AsyncSession(bind=connection, join_transaction_mode="create_savepoint")
+                try:
+                    yield db
+                finally:
+                    await db.close()
+                    await transaction.rollback()
+        finally:
+            await async_engine.dispose()
+
+    return session
+
+
+@pytest.fixture
+def new_prefix():
+    # MRNs and visit account numbers of a test start with one, so they
+    # cannot clash with rows already in the database
+    return lambda: f"TEST-{uuid.uuid4().hex[:8]}-"
+
+
+@pytest.fixture
+def snapshot(db):
+    # Everything ingested under a prefix, without the prefix and the
+    # generated ids, so runs under different prefixes can be compared
+    def take(prefix: str) -> dict:
+        persons = db.execute(
+            text(
+                """
+                SELECT p.mrn, pe.first_name, pe.last_name, pe.birth_date
+                FROM patients p
+                JOIN persons pe ON pe.id = p.id
+                WHERE p.mrn LIKE :prefix
+                """
+            ),
+            {"prefix": prefix + "%"},
+        ).all()
+        visits = db.execute(
+            text(
+                """
+                SELECT p.mrn, v.visit_account_number, v.visit_date, v.reason
+                FROM visits v
+                JOIN patients p ON p.id = v.patient_id
+                WHERE p.mrn LIKE :prefix
+                """
+            ),
+            {"prefix": prefix + "%"},
+        ).all()
+
+        def strip(value):
+            if isinstance(value, str) and value.startswith(prefix):
+                return value[len(prefix):]
+            return value
+
+        def ordered(rows) -> list:
+            return sorted(
+                (tuple(map(strip, row)) for row in rows),
+                key=lambda row: [(v is None, str(v)) for v in row],
+            )
+
+        return {"persons": ordered(persons), "visits": ordered(visits)}
+
+    return take
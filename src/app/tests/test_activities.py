@@ -0,0 +1,107 @@
+import functools
+import io
+import json
+import threading
+from contextlib import contextmanager
+from datetime import date
+
+from sqlalchemy import text
+from temporalio.testing import ActivityEnvironment
+
+from services import ingestion, s3
+from services.csvio import CSV_HEADERS
+from services.partitions import ensure_visit_partitions
+from temporal import activities
+
+
+def item(prefix: str, mrn: str, first_name: str, visit_account_number) -> dict:
+    return {
+        "mrn": prefix + mrn,
+        "first_name": first_name,
+        "last_name": "Doe",
+        "birth_date": "1980-01-01",
+        "visit_account_number": None if visit_account_number is None else prefix + visit_account_number,
+        "visit_date": "2020-01-05",
+        "reason": "checkup",
+    }
+
+
+def test_upload_leaves_out_account_numbers_whose_last_row_is_unchanged(db, new_prefix, monkeypatch):
+    ensure_visit_partitions([date(2020, 1, 1)])
+    prefix = new_prefix()
+    sent = [
+        item(prefix, "MRN1", "Ann", "VAN1"),
+        item(prefix, "MRN1", "Anne", "VAN1"),
+        item(prefix, "MRN2", "Bob", "VAN2"),
+    ]
+    ingestion.ingest(db, sent)
+
+    resent = sent + [
+        item(prefix, "MRN2", "Rob", "VAN2"),
+        item(prefix, "MRN3", "Cy", "VAN3"),
+        item(prefix, "MRN3", "Cy", None),
+    ]
+    entry_id = db.execute(
+        text("INSERT INTO ingestions (payload, md5_hash) VALUES (CAST(:payload AS JSONB), :md5) RETURNING id"),
+        {"payload": json.dumps(resent), "md5": prefix},
+    ).scalar()
+
+    uploaded = []
+    monkeypatch.setattr(
+        activities,
+        "upload_rows",
+        lambda rows, name: (uploaded.extend(map(tuple, rows)), (name, "s3://bucket/" + name))[1],
+    )
+    activities._upload_ingestions(db, [entry_id], "test")
+
+    # VAN1 is left out entirely, VAN2 changed (its last row is new)
+    assert [row[CSV_HEADERS.index("first_name")] for row in uploaded] == ["Bob", "Rob", "Cy", "Cy"]
+
+
+# Reports upload progress from its own thread in small steps, like boto3's
+# transfer threads do for each part
+class FakeS3Client:
+    def __init__(self) -> None:
+        self.objects = {}
+
+    def upload_fileobj(self, stream, bucket, key, ExtraArgs, Config, Callback):
+        def upload():
+            data = b""
+            while chunk := stream.read(16):
+                data += chunk
+                Callback(len(chunk))
+            self.objects[key] = data
+
+        thread = threading.Thread(target=upload)
+        thread.start()
+        thread.join()
+
+
+def test_split_heartbeats_while_shards_upload(monkeypatch):
+    body = "".join(
+        ["mrn,first_name\n"] + [f"MRN{i},Name{i}\n" for i in range(50)]
+    ).encode()
+
+    @contextmanager
+    def open_csv_stream(s3path, offset=0, compressed=False):
+        yield io.BytesIO(body)
+
+    client = FakeS3Client()
+    monkeypatch.setattr(s3, "get_s3_client", lambda: client)
+    monkeypatch.setattr(activities, "object_size", lambda s3path: len(body))
+    monkeypatch.setattr(activities, "detect_format", lambda s3path: "csv")
+    monkeypatch.setattr(activities, "open_csv_stream", open_csv_stream)
+    monkeypatch.setattr(activities, "INGEST_SHARD_MIN_BYTES", 0)
+    monkeypatch.setattr(
+        activities, "upload_stream", functools.partial(s3.upload_stream, progress_every=64)
+    )
+
+    heartbeats = []
+    env = ActivityEnvironment()
+    env.on_heartbeat = lambda *details: heartbeats.append(details)
+    s3_paths = env.run(activities.split_csv_file, "s3://bucket/ingestions/big.csv", 2)
+
+    assert len(s3_paths) == 2
+    assert b"".join(client.objects.values()).count(b"MRN") == 50
+    # Besides one heartbeat per finished shard, the uploads themselves heartbeat
+    assert len(heartbeats) > len(s3_paths)
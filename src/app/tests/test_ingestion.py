@@ -0,0 +1,137 @@
+import csv
+import io
+import json
+from datetime import date
+
+import pytest
+
+from services import ingestion
+from services.csvio import CSV_HEADERS
+from services.ingestion import CsvRecordReader, bulk_ingest_rows, ingest_csv_chunks, ingest_rows
+from services.partitions import ensure_visit_partitions
+
+
+def visit_rows(prefix: str) -> list:
+    def row(mrn, first_name, visit_account_number, visit_date, reason):
+        return {
+            "mrn": prefix + mrn,
+            "first_name": first_name,
+            "last_name": "Doe",
+            "birth_date": "1980-01-01",
+            "visit_account_number": None if visit_account_number is None else prefix + visit_account_number,
+            "visit_date": visit_date,
+            "reason": reason,
+        }
+
+    return [
+        row("MRN1", "Ann", "VAN1", "2020-01-05", "checkup"),
+        row("MRN1", "Anne", None, "2020-01-06", "walk-in"),
+        row("MRN2", "Bob", None, "2020-02-01", "walk-in"),
+        # Repeated account number: the first row wins
+        row("MRN2", None, "VAN1", "2020-02-02", "ignored"),
+        row("MRN1", None, None, "2020-01-06", "walk-in"),
+        row("MRN2", "Rob", "VAN2", "2020-02-03", "follow-up"),
+    ]
+
+
+def test_bulk_matches_row_mode_for_rows_without_account_number(db, snapshot, new_prefix):
+    # Created up front: the ingestion would create them on a connection of its
+    # own, which waits behind this test's open transaction
+    ensure_visit_partitions([date(2020, 1, 1), date(2020, 2, 1)])
+
+    row_prefix, bulk_prefix = new_prefix(), new_prefix()
+    assert ingest_rows(db, visit_rows(row_prefix)) == 6
+    assert bulk_ingest_rows(db, visit_rows(bulk_prefix)) == 6
+
+    expected = snapshot(row_prefix)
+    assert len(expected["visits"]) == 5
+    assert [v for v in expected["visits"] if v[1] is None] == [
+        ("MRN1", None, date(2020, 1, 6), "walk-in"),
+        ("MRN1", None, date(2020, 1, 6), "walk-in"),
+        ("MRN2", None, date(2020, 2, 1), "walk-in"),
+    ]
+    assert snapshot(bulk_prefix) == expected
+
+
+def csv_bytes(prefix: str) -> bytes:
+    # CRLF line endings, quoted fields spanning lines and multibyte UTF-8, so
+    # record boundaries do not line up with lines or characters with bytes
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\r\n")
+    writer.writerow(CSV_HEADERS)
+    writer.writerows(
+        [
+            [prefix + "MRN1", "José", "Núñez", "1980-01-01", prefix + "VAN1", "2020-01-05", "checkup"],
+            [prefix + "MRN2", "Zoë", "李", "1975-06-30", prefix + "VAN2", "2020-01-06", "line one\r\nline two"],
+            [prefix + "MRN1", "", "", "", prefix + "VAN3", "2020-02-01", 'says "hi"\nand leaves'],
+            [prefix + "MRN3", "Chloé", "Ålund", "1990-12-12", prefix + "VAN4", "2020-02-02", "ünïcödé, with comma"],
+            [prefix + "MRN2", "Zoé", "", "", prefix + "VAN2", "2020-02-03", "repeated account"],
+            [prefix + "MRN4", "Åsa", "Øster", "2000-02-29", prefix + "VAN5", "2020-01-31", "\n"],
+            [prefix + "MRN3", "", "Ålund-Berg", "", prefix + "VAN6", "2020-02-28", "last"],
+        ]
+    )
+    return output.getvalue().encode("utf-8")
+
+
+def test_csv_record_reader_resumes_at_record_boundaries():
+    data = csv_bytes("P-")
+    expected = list(CsvRecordReader(io.BytesIO(data)))
+    assert len(expected) == 7
+
+    for stop in range(len(expected) + 1):
+        reader = CsvRecordReader(io.BytesIO(data))
+        records = iter(reader)
+        head = [next(records) for _ in range(stop)]
+        resumed = CsvRecordReader(io.BytesIO(data[reader.offset:]), reader.offset, reader.fieldnames)
+        assert head + list(resumed) == expected
+        assert resumed.offset == len(data)
+
+
+@pytest.mark.parametrize("mode", ["bulk", "row"])
+def test_ingest_csv_chunks_resumes_from_checkpoint(db, snapshot, new_prefix, monkeypatch, mode):
+    monkeypatch.setattr(ingestion, "INGEST_MODE", mode)
+    ensure_visit_partitions([date(2020, 1, 1), date(2020, 2, 1)])
+
+    single_prefix, resumed_prefix = new_prefix(), new_prefix()
+    checkpoints = list(ingest_csv_chunks(db, io.BytesIO(csv_bytes(single_prefix)), chunk_size=2))
+    assert [c["rows"] for c in checkpoints] == [2, 4, 6, 7]
+
+    data = csv_bytes(resumed_prefix)
+    chunks = ingest_csv_chunks(db, io.BytesIO(data), chunk_size=2)
+    next(chunks)
+    checkpoint = next(chunks)
+    chunks.close()
+
+    # What the retried activity gets back from its last heartbeat
+    checkpoint = json.loads(json.dumps(checkpoint))
+    resumed = list(
+        ingest_csv_chunks(db, io.BytesIO(data[checkpoint["offset"]:]), checkpoint, chunk_size=2)
+    )
+    assert [c["rows"] for c in resumed] == [6, 7]
+    assert resumed[-1]["offset"] == len(data)
+
+    expected = snapshot(single_prefix)
+    assert len(expected["persons"]) == 4
+    assert ("MRN2", "VAN2", date(2020, 1, 6), "line one\r\nline two") in expected["visits"]
+    assert len(expected["visits"]) == 6
+    assert snapshot(resumed_prefix) == expected
+
+
+@pytest.mark.parametrize("mode", ["bulk", "row"])
+def test_resending_rows_with_repeated_account_numbers_changes_nothing(db, snapshot, new_prefix, monkeypatch, mode):
+    monkeypatch.setattr(ingestion, "INGEST_MODE", mode)
+    ensure_visit_partitions([date(2020, 1, 1), date(2020, 2, 1)])
+
+    prefix = new_prefix()
+    # Rows without an account number cannot be recognized and are left out
+    rows = [
+        {**row, "visit_account_number": prefix + van}
+        for row, van in zip(visit_rows(prefix), ["VAN1", "VAN1", "VAN2", "VAN2", "VAN1", "VAN3"])
+    ]
+
+    ingestion.ingest(db, rows)
+    first = snapshot(prefix)
+    assert first["persons"][0][:2] == ("MRN1", "Anne")
+
+    ingestion.ingest(db, rows)
+    assert snapshot(prefix) == first
@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from routes import inputs
+from services import outbox
+
+
+class Request:
+    def __init__(self, items: list) -> None:
+        self._body = json.dumps(items).encode()
+
+    async def body(self) -> bytes:
+        return self._body
+
+
+def items(prefix: str) -> list:
+    return [
+        {
+            "mrn": prefix + "MRN1",
+            "first_name": "Ann",
+            "last_name": "Doe",
+            "birth_date": "1980-01-01",
+            "visit_account_number": prefix + "VAN1",
+            "visit_date": "2020-01-05",
+            "reason": "checkup",
+        }
+    ]
+
+
+async def outbox_rows(db: AsyncSession, entry_id: int) -> list:
+    return (
+        await db.execute(
+            text(
+                """
+                SELECT attempts, available_at > NOW() AS delayed, last_error
+                FROM workflow_outbox
+                WHERE ingestion_id = :id
+                """
+            ),
+            {"id": entry_id},
+        )
+    ).all()
+
+
+def test_ingest_commits_the_ingestion_with_its_outbox_row(async_db, new_prefix):
+    async def run():
+        async with async_db() as db:
+            created = await inputs.ingest(Request(items(new_prefix())), db)
+            assert created["status"] == "created"
+            assert await outbox_rows(db, created["id"]) == [(0, False, None)]
+
+    asyncio.run(run())
+
+
+def test_ingest_leaves_nothing_behind_when_queueing_fails(async_db, new_prefix, monkeypatch):
+    async def enqueue_then_fail(db, entry_id):
+        await outbox.enqueue_conversion(db, entry_id)
+        raise RuntimeError("enqueue failed")
+
+    monkeypatch.setattr(inputs, "enqueue_conversion", enqueue_then_fail)
+    request = Request(items(new_prefix()))
+
+    async def run():
+        async with async_db() as db:
+            with pytest.raises(RuntimeError):
+                await inputs.ingest(request, db)
+            await db.rollback()
+
+            # The outbox row references the ingestion, so neither is left
+            remaining = (
+                await db.execute(
+                    text("SELECT COUNT(*) FROM ingestions WHERE payload::text LIKE :mrn"),
+                    {"mrn": "%" + json.loads(await request.body())[0]["mrn"] + "%"},
+                )
+            ).scalar()
+            assert remaining == 0
+
+            # and sending the payload again creates it anew
+            monkeypatch.setattr(inputs, "enqueue_conversion", outbox.enqueue_conversion)
+            assert (await inputs.ingest(request, db))["status"] == "created"
+
+    asyncio.run(run())
+
+
+def test_failed_dispatch_is_retried(async_db, new_prefix, monkeypatch):
+    started = []
+    failing = True
+
+    async def start_csv_conversion(entry_id):
+        if failing:
+            raise RuntimeError("Temporal unavailable")
+        started.append(entry_id)
+
+    monkeypatch.setattr(outbox, "start_csv_conversion", start_csv_conversion)
+
+    async def run():
+        nonlocal failing
+        async with async_db() as db:
+            entry_id = (await inputs.ingest(Request(items(new_prefix())), db))["id"]
+            # Every dispatch runs in a session of its own on the test's
+            # connection, like the dispatcher's own sessions
+            monkeypatch.setattr(
+                outbox,
+                "AsyncSessionLocal",
+                lambda: AsyncSession(bind=db.bind, join_transaction_mode="create_savepoint"),
+            )
+            dispatcher = outbox.OutboxDispatcher()
+
+            await dispatcher.dispatch_once()
+            [(attempts, delayed, last_error)] = await outbox_rows(db, entry_id)
+            assert (attempts, delayed) == (1, True)
+            assert "Temporal unavailable" in last_error
+
+            # Not picked up again before the backoff has passed
+            failing = False
+            await dispatcher.dispatch_once()
+            assert entry_id not in started
+            assert len(await outbox_rows(db, entry_id)) == 1
+
+            await db.execute(
+                text("UPDATE workflow_outbox SET available_at = NOW() WHERE ingestion_id = :id"),
+                {"id": entry_id},
+            )
+            await db.commit()
+            await dispatcher.dispatch_once()
+            assert entry_id in started
+            assert await outbox_rows(db, entry_id) == []
+
+    asyncio.run(run())
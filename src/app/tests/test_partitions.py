@@ -0,0 +1,90 @@
+import threading
+from datetime import date
+
+import pytest
+from sqlalchemy import text
+
+from services import ingestion
+from services.database import engine
+from services.partitions import ensure_visit_partitions
+
+
+def visit(prefix: str, mrn: str, visit_date: str, reason: str) -> dict:
+    return {
+        "mrn": prefix + mrn,
+        "first_name": "Ann",
+        "last_name": "Doe",
+        "birth_date": "1980-01-01",
+        "visit_account_number": prefix + "VAN1",
+        "visit_date": visit_date,
+        "reason": reason,
+    }
+
+
+@pytest.mark.parametrize("mode", ["bulk", "row"])
+def test_account_number_stays_unique_across_partitions(db, snapshot, new_prefix, monkeypatch, mode):
+    monkeypatch.setattr(ingestion, "INGEST_MODE", mode)
+    ensure_visit_partitions([date(2020, 1, 1), date(2020, 3, 1)])
+
+    prefix = new_prefix()
+    ingestion.ingest(db, [visit(prefix, "MRN1", "2020-01-05", "checkup")])
+    # Same account number in another month, so in another partition, where
+    # no unique index of visits could see the first visit
+    ingestion.ingest(db, [visit(prefix, "MRN2", "2020-03-10", "duplicate")])
+
+    assert snapshot(prefix)["visits"] == [("MRN1", "VAN1", date(2020, 1, 5), "checkup")]
+    registered = db.execute(
+        text("SELECT visit_date FROM visit_account_numbers WHERE visit_account_number = :van"),
+        {"van": prefix + "VAN1"},
+    ).scalar_one()
+    assert registered == date(2020, 1, 5)
+
+
+# Months no other test or real data uses; their partitions are created here
+# for real, on connections of their own, and dropped again afterwards
+MONTHS = [date(1990, 1, 1), date(1990, 2, 1), date(1990, 3, 1)]
+
+
+def drop_partitions() -> None:
+    with engine.begin() as conn:
+        for month in MONTHS:
+            conn.execute(text(f"DROP TABLE IF EXISTS visits_{month:%Y_%m}"))
+
+
+def test_concurrent_partition_creation_does_not_fail(migrated):
+    drop_partitions()
+    workers = 8
+    barrier = threading.Barrier(workers)
+    errors = []
+    created = []
+
+    def create() -> None:
+        try:
+            with engine.begin() as conn:
+                barrier.wait()
+                created.append(
+                    conn.execute(
+                        text("SELECT ensure_visit_partitions(CAST(:months AS DATE[]))"),
+                        {"months": MONTHS},
+                    ).scalar()
+                )
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        threads = [threading.Thread(target=create) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        # Each month was created by exactly one of the sessions
+        assert sorted(created) == [0] * (workers - 1) + [len(MONTHS)]
+        with engine.connect() as conn:
+            for month in MONTHS:
+                assert conn.execute(
+                    text("SELECT to_regclass(:name)"), {"name": f"visits_{month:%Y_%m}"}
+                ).scalar() is not None
+    finally:
+        drop_partitions()
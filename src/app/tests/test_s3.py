@@ -0,0 +1,31 @@
+import gzip
+import io
+
+from services import s3
+
+
+class FakeS3Client:
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def get_object(self, Bucket, Key, Range=None):
+        start = int(Range[len("bytes="):].rstrip("-")) if Range else 0
+        return {"Body": io.BytesIO(self.data[start:])}
+
+
+def test_gzip_resume_skips_to_offset_in_chunks_and_reports_progress(monkeypatch):
+    body = b"".join(b"MRN%d,Name%d\n" % (i, i) for i in range(1000))
+    monkeypatch.setattr(s3, "get_s3_client", lambda: FakeS3Client(gzip.compress(body)))
+
+    offset = body.index(b"MRN500,")
+    skipped = []
+    with s3.open_csv_stream(
+        "s3://bucket/ingestions/file.csv.gz",
+        offset,
+        compressed=True,
+        progress=skipped.append,
+        progress_every=1000,
+    ) as stream:
+        assert stream.read() == body[offset:]
+
+    assert skipped == [*range(1000, offset, 1000), offset]
@@ -0,0 +1,80 @@
+import hashlib
+import json
+from typing import List
+
+import pytest
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+
+from models import IngestItem
+from services.uploads import PayloadHasher, canonical_payload, normalize_item
+
+ITEMS = TypeAdapter(List[IngestItem])
+
+
+# What /ingest hashed before the hand-built encoding: the items validated as
+# models, normalized and dumped with sorted keys
+def previous_canonical(body: bytes) -> str:
+    items = ITEMS.validate_python(json.loads(body))
+    return json.dumps(
+        [normalize_item(item) for item in items], sort_keys=True, separators=(",", ":")
+    )
+
+
+def item(**overrides) -> dict:
+    return {
+        "mrn": "MRN1",
+        "first_name": "Ann",
+        "last_name": "Doe",
+        "birth_date": "1980-01-01",
+        "visit_account_number": "VAN1",
+        "visit_date": "2020-01-05",
+        "reason": "checkup",
+        **overrides,
+    }
+
+
+PAYLOADS = {
+    "sorted keys": json.dumps([item()]).encode(),
+    "key order": json.dumps([dict(reversed(list(item().items())))]).encode(),
+    "whitespace": json.dumps([item(), item(mrn="MRN2")], indent=4).encode(),
+    "compact": json.dumps([item()], separators=(",", ":")).encode(),
+    "unicode": json.dumps(
+        [item(first_name="José", last_name="李小龍", reason="Zoë 😀  ")], ensure_ascii=False
+    ).encode(),
+    "unicode escapes": json.dumps([item(first_name="José", reason="😀")]).encode(),
+    "control characters": json.dumps([item(reason='tab\there "quoted"\n\\ back\x00slash')]).encode(),
+    "digit strings": json.dumps([item(mrn="00123", visit_account_number="1e3", reason="1.50")]).encode(),
+    "date from datetime": json.dumps([item(birth_date="1980-01-01T00:00:00")]).encode(),
+    "extra field": json.dumps([item(note="ignored")]).encode(),
+    "empty strings": json.dumps([item(first_name="", reason="")]).encode(),
+    "empty payload": b"[]",
+}
+
+
+@pytest.mark.parametrize("body", PAYLOADS.values(), ids=PAYLOADS.keys())
+def test_canonical_payload_matches_previous_encoding(body):
+    assert canonical_payload(body) == previous_canonical(body)
+
+
+@pytest.mark.parametrize("body", PAYLOADS.values(), ids=PAYLOADS.keys())
+def test_payload_hasher_matches_previous_hash(body):
+    hasher = PayloadHasher()
+    for record in json.loads(body):
+        hasher.update(normalize_item(IngestItem.model_validate(record)))
+
+    expected = hashlib.md5(previous_canonical(body).encode("utf-8")).hexdigest()
+    assert hasher.hexdigest() == expected
+
+
+@pytest.mark.parametrize(
+    "record",
+    [item(mrn=123), item(reason=1.5), item(first_name=None), item(birth_date="not a date")],
+    ids=["int", "float", "null", "bad date"],
+)
+def test_canonical_payload_rejects_what_the_models_reject(record):
+    body = json.dumps([record]).encode()
+    with pytest.raises(ValidationError):
+        previous_canonical(body)
+    with pytest.raises(RequestValidationError):
+        canonical_payload(body)
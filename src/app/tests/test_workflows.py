@@ -0,0 +1,258 @@
+import asyncio
+
+import pytest
+from temporalio import activity, workflow
+from temporalio.api.enums.v1 import EventType
+from temporalio.api.history.v1 import HistoryEvent
+from temporalio.client import WorkflowExecutionStatus, WorkflowHistory
+from temporalio.converter import DataConverter
+from temporalio.exceptions import ApplicationError
+from temporalio.testing import WorkflowEnvironment
+from temporalio.worker import Replayer, UnsandboxedWorkflowRunner, Worker
+
+from temporal.workflows.batch import CsvBatchWorkflow
+from temporal.workflows.conversion import CsvConversionWorkflow
+from temporal.workflows.ingestion import CsvIngestionWorkflow
+
+TASK_QUEUE = "background-task-queue"
+
+to_payloads = DataConverter.default.payload_converter.to_payloads
+
+
+# Builds the history a server would have recorded for a workflow whose
+# activities all succeed at the first attempt, so histories written by earlier
+# versions of a workflow can be replayed against the current code
+class History:
+    def __init__(self, workflow_type: str, *args) -> None:
+        self.events: list[HistoryEvent] = []
+        self.activities = 0
+        self._add(
+            EventType.EVENT_TYPE_WORKFLOW_EXECUTION_STARTED,
+            "workflow_execution_started_event_attributes",
+            workflow_type={"name": workflow_type},
+            task_queue={"name": TASK_QUEUE},
+            input={"payloads": to_payloads(list(args))},
+        )
+        self._workflow_task()
+
+    def _add(self, event_type, attributes: str, **values) -> int:
+        event = HistoryEvent(
+            event_id=len(self.events) + 1, event_type=event_type, **{attributes: values}
+        )
+        event.event_time.FromSeconds(1_700_000_000 + len(self.events))
+        self.events.append(event)
+        return event.event_id
+
+    def _workflow_task(self) -> None:
+        scheduled = self._add(
+            EventType.EVENT_TYPE_WORKFLOW_TASK_SCHEDULED,
+            "workflow_task_scheduled_event_attributes",
+            task_queue={"name": TASK_QUEUE},
+        )
+        started = self._add(
+            EventType.EVENT_TYPE_WORKFLOW_TASK_STARTED,
+            "workflow_task_started_event_attributes",
+            scheduled_event_id=scheduled,
+        )
+        self.completed = self._add(
+            EventType.EVENT_TYPE_WORKFLOW_TASK_COMPLETED,
+            "workflow_task_completed_event_attributes",
+            scheduled_event_id=scheduled,
+            started_event_id=started,
+        )
+
+    def patch(self, patch_id: str) -> "History":
+        self._add(
+            EventType.EVENT_TYPE_MARKER_RECORDED,
+            "marker_recorded_event_attributes",
+            marker_name="core_patch",
+            details={"patch-data": {"payloads": to_payloads([{"id": patch_id, "deprecated": False}])}},
+            workflow_task_completed_event_id=self.completed,
+        )
+        return self
+
+    def activity(self, name: str, result=None) -> "History":
+        self.activities += 1
+        scheduled = self._add(
+            EventType.EVENT_TYPE_ACTIVITY_TASK_SCHEDULED,
+            "activity_task_scheduled_event_attributes",
+            activity_id=str(self.activities),
+            activity_type={"name": name},
+            workflow_task_completed_event_id=self.completed,
+        )
+        started = self._add(
+            EventType.EVENT_TYPE_ACTIVITY_TASK_STARTED,
+            "activity_task_started_event_attributes",
+            scheduled_event_id=scheduled,
+        )
+        self._add(
+            EventType.EVENT_TYPE_ACTIVITY_TASK_COMPLETED,
+            "activity_task_completed_event_attributes",
+            scheduled_event_id=scheduled,
+            started_event_id=started,
+            result={"payloads": to_payloads([result])},
+        )
+        self._workflow_task()
+        return self
+
+    def completed_with(self, result) -> WorkflowHistory:
+        self._add(
+            EventType.EVENT_TYPE_WORKFLOW_EXECUTION_COMPLETED,
+            "workflow_execution_completed_event_attributes",
+            result={"payloads": to_payloads([result])},
+            workflow_task_completed_event_id=self.completed,
+        )
+        return WorkflowHistory("replayed-workflow", self.events)
+
+
+def replay(workflow_class, history: WorkflowHistory) -> None:
+    asyncio.run(Replayer(workflows=[workflow_class]).replay_workflow(history))
+
+
+S3_PATH = "s3://bucket/ingestion_1.csv"
+
+
+def test_conversion_replays_two_step_history():
+    history = (
+        History("CsvConversionWorkflow", 1)
+        .activity("get_ingestion", {"status": "new", "s3_path": None})
+        .activity("convert_to_csv_and_mark_converted", "converted")
+        .activity("get_ingestion", {"status": "converted", "s3_path": None})
+        .activity("upload_csv_to_s3_and_mark_uploaded", "uploaded")
+        .activity("get_ingestion", {"status": "uploaded", "s3_path": S3_PATH})
+        .activity("process_csv_file")
+        .completed_with("uploaded")
+    )
+    replay(CsvConversionWorkflow, history)
+
+
+def test_conversion_replays_single_activity_history():
+    history = (
+        History("CsvConversionWorkflow", 1)
+        .patch("single-conversion-activity")
+        .patch("ingestion-status-lookup")
+        .activity("get_ingestion_status", {"status": "new", "s3_path": None})
+        .activity("convert_and_upload_csv", {"status": "uploaded", "s3_path": S3_PATH})
+        .activity("process_csv_file")
+        .completed_with("uploaded")
+    )
+    replay(CsvConversionWorkflow, history)
+
+
+def test_conversion_replays_history_with_lookup_after_conversion():
+    history = (
+        History("CsvConversionWorkflow", 1)
+        .patch("single-conversion-activity")
+        .activity("get_ingestion", {"status": "new", "s3_path": None})
+        .activity("convert_and_upload_csv", {"status": "uploaded", "s3_path": S3_PATH})
+        .activity("get_ingestion", {"status": "uploaded", "s3_path": S3_PATH})
+        .activity("process_csv_file")
+        .completed_with("uploaded")
+    )
+    replay(CsvConversionWorkflow, history)
+
+
+async def start_time_skipping() -> WorkflowEnvironment:
+    # The test server is downloaded on first use
+    try:
+        return await WorkflowEnvironment.start_time_skipping()
+    except RuntimeError as e:
+        pytest.skip(f"Temporal test server not available: {e}")
+
+
+async def eventually(condition) -> None:
+    for _ in range(200):
+        if condition():
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError("condition not met in time")
+
+
+def test_batch_continues_as_new_with_pending_ids_and_converts_a_failed_batch_one_by_one(monkeypatch):
+    bad = 3
+    batches, converted, failed, ingested = [], [], [], []
+
+    @activity.defn(name="convert_and_upload_batch")
+    async def convert_and_upload_batch(entry_ids: list[int]) -> list[str]:
+        batches.append(entry_ids)
+        if bad in entry_ids:
+            raise ApplicationError("bad payload", non_retryable=True)
+        return [f"s3://bucket/ingestion_batch_{entry_ids[0]}.csv"]
+
+    @activity.defn(name="convert_and_upload_csv")
+    async def convert_and_upload_csv(entry_id: int) -> dict:
+        converted.append(entry_id)
+        if entry_id == bad:
+            raise ApplicationError("bad payload", non_retryable=True)
+        return {"status": "uploaded", "s3_path": f"s3://bucket/ingestion_{entry_id}.csv"}
+
+    @activity.defn(name="mark_failed")
+    async def mark_failed(entry_id: int) -> None:
+        failed.append(entry_id)
+
+    @activity.defn(name="ingest_csv_from_s3")
+    async def ingest_csv_from_s3(s3path: str) -> str:
+        ingested.append(s3path)
+        return "ingested"
+
+    @activity.defn(name="mark_ingested")
+    async def mark_ingested(s3path: str) -> None:
+        pass
+
+    # The server only suggests it once the history is large; here every
+    # batch is followed by a continue-as-new
+    monkeypatch.setattr(workflow.Info, "is_continue_as_new_suggested", lambda self: True)
+
+    async def run():
+        env = await start_time_skipping()
+        async with env:
+            client = env.client
+            # Unsandboxed, so the workflow sees the patched Info
+            async with Worker(
+                client,
+                task_queue=TASK_QUEUE,
+                workflows=[CsvBatchWorkflow, CsvIngestionWorkflow],
+                activities=[mark_failed, mark_ingested],
+                workflow_runner=UnsandboxedWorkflowRunner(),
+            ), Worker(
+                client,
+                task_queue=f"{TASK_QUEUE}-conversion",
+                activities=[convert_and_upload_batch, convert_and_upload_csv],
+            ), Worker(
+                client,
+                task_queue=f"{TASK_QUEUE}-ingestion",
+                activities=[ingest_csv_from_s3],
+            ):
+                handle = await client.start_workflow(
+                    CsvBatchWorkflow.run,
+                    {"max_size": 2, "window_seconds": 60},
+                    id="ingest-batch-test",
+                    task_queue=TASK_QUEUE,
+                )
+                # The handle is not bound to a run: signals go to the current one
+                for entry_id in (1, 2, bad, 4):
+                    await handle.signal(CsvBatchWorkflow.add, entry_id)
+
+                await eventually(lambda: len(ingested) == 2)
+
+                # 3 and 4 were left for a later run, where their batch failed
+                # and each was converted on its own
+                assert batches == [[1, 2], [bad, 4]]
+                assert sorted(converted) == [bad, 4]
+                assert failed == [bad]
+                assert sorted(ingested) == [
+                    "s3://bucket/ingestion_4.csv",
+                    "s3://bucket/ingestion_batch_1.csv",
+                ]
+
+                first_run = client.get_workflow_handle(
+                    handle.id, run_id=handle.first_execution_run_id
+                )
+                assert (await first_run.describe()).status == WorkflowExecutionStatus.CONTINUED_AS_NEW
+                current = await handle.describe()
+                assert current.status == WorkflowExecutionStatus.RUNNING
+                assert current.run_id != handle.first_execution_run_id
+
+                await handle.terminate()
+
+    asyncio.run(run())